@@ -1,14 +1,34 @@
-import json
+import asyncio
+import bisect
+import contextlib
+import datetime
+import functools
+import hashlib
+import hmac
 import logging
 import os
+import secrets
+import signal
+import time
+from collections import OrderedDict, deque
 
+from aiohttp import web
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-import googleapiclient.http
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ConversationHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, ConversationHandler
+
+from drive import DRIVE_FOLDER_MIME_TYPE, DriveClient, DriveError, TokenUnavailable, close_http_session
+from storage import storage
+from transfer import (
+    DOWNLOAD_BUFFER_SIZE, DOWNLOAD_CHUNK_SIZE, MB, TELEGRAM_LOCAL_MODE, UPLOAD_BUFFER_SIZE, UPLOAD_CHUNK_SIZE,
+    LocalFileSource, Spool, TransferJob, counted_chunks, fill_spool, format_size, governor, io_executor,
+    is_local_file_path, scheduler, send_document_stream, spool_reservation, stop_spool, stream_upload_to_drive,
+    sweep_spool_dir, sweep_spool_periodically, upload_latency, upload_metrics,
+)
 
 # Setup logging
 logging.basicConfig(
@@ -34,9 +54,32 @@ if not TELEGRAM_TOKEN or not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
     logger.error("Missing TELEGRAM_TOKEN or GOOGLE_CLIENT_ID or GOOGLE_CLIENT_SECRET environment variables")
     exit(1)
 
-# Since we remove local session and file storage, we keep sessions and files in memory only (will reset on restart)
-sessions = {}  # user_id -> credentials dict
-files = {}     # user_id -> list of files metadata
+# Point these at a self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api) to lift
+# the cloud API's 20 MB download / 50 MB upload limits; with --local it also hands us file paths.
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+TELEGRAM_API_FILE_URL = os.getenv('TELEGRAM_API_FILE_URL', 'https://api.telegram.org/file/bot')
+
+if TELEGRAM_LOCAL_MODE:
+    TELEGRAM_DOWNLOAD_LIMIT = None  # the local server serves files of any size
+    TELEGRAM_UPLOAD_LIMIT = 2000 * MB
+else:
+    TELEGRAM_DOWNLOAD_LIMIT = 20 * MB
+    TELEGRAM_UPLOAD_LIMIT = 50 * MB
+
+# BOT_MODE=webhook receives updates on the same web server as the OAuth callback instead of long polling
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', f'https://{REDIRECT_HOST}{WEBHOOK_PATH}')
+# Every instance behind a load balancer must agree on the secret, so derive the default from the token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '256'))  # accepted updates not processed yet
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+if BOT_MODE not in ('polling', 'webhook'):
+    logger.error(f"Unknown BOT_MODE {BOT_MODE!r}, expected 'polling' or 'webhook'")
+    exit(1)
+
+ADMIN_USER_IDS = {int(x) for x in os.getenv('ADMIN_USER_IDS', '').split(',') if x.strip()}
 
 # OAuth2 flow setup
 def create_flow(state=None):
@@ -55,10 +98,34 @@ def create_flow(state=None):
         state=state
     )
 
-from aiohttp import web
+LOGIN_TIMEOUT = int(os.getenv('LOGIN_TIMEOUT', '600'))
+
+class PendingLogin:
+    def __init__(self, user_id, chat_id, flow):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.flow = flow
+        self.expires_at = time.monotonic() + LOGIN_TIMEOUT
 
-# We remove HTTP server and get_auth_code function
-# Instead, user must manually provide the auth code from the redirect URL
+# OAuth state -> PendingLogin; the state is random so the callback cannot be forged from a user id
+pending_logins = {}
+
+def purge_pending_logins():
+    now = time.monotonic()
+    for state, pending in list(pending_logins.items()):
+        if pending.expires_at < now:
+            del pending_logins[state]
+
+def pending_login_for_user(user_id):
+    purge_pending_logins()
+    for state, pending in pending_logins.items():
+        if pending.user_id == user_id:
+            return state, pending
+    return None, None
+
+async def complete_login(user_id, flow, code):
+    await io_executor.run(user_id, flow.fetch_token, code=code)
+    await tokens.set(user_id, flow.credentials)
 
 routes = web.RouteTableDef()
 
@@ -66,15 +133,78 @@ routes = web.RouteTableDef()
 async def oauth2callback(request):
     code = request.query.get('code')
     state = request.query.get('state')
-    if not code or not state:
-        return web.Response(text="Kode atau state tidak ditemukan di URL.", status=400)
-    # Simpan kode dan state ke tempat yang bisa diakses oleh bot, misalnya file sementara atau variabel global
-    # Untuk kesederhanaan, kita simpan di file sementara dengan nama berdasarkan state (user_id)
-    filename = f"auth_code_{state}.txt"
-    with open(filename, 'w') as f:
-        f.write(code)
+    purge_pending_logins()
+    pending = pending_logins.pop(state, None) if state else None
+    if pending is None:
+        return web.Response(text="Link login tidak valid atau sudah kadaluarsa. Silakan /login lagi.", status=400)
+    bot = request.app['bot']
+    if not code:
+        await bot.send_message(pending.chat_id, "Login dibatalkan. Gunakan /login untuk mencoba lagi.")
+        return web.Response(text="Kode tidak ditemukan di URL.", status=400)
+    try:
+        await complete_login(pending.user_id, pending.flow, code)
+    except Exception as e:
+        logger.error(f"Error fetching token: {e}")
+        await bot.send_message(pending.chat_id, "Gagal login, kode tidak valid atau sudah kadaluarsa.")
+        return web.Response(text="Gagal login. Silakan kembali ke Telegram dan coba lagi.", status=400)
+    await bot.send_message(pending.chat_id, "Login berhasil! Anda sekarang dapat mengupload file.")
     return web.Response(text="Login berhasil! Anda dapat kembali ke Telegram dan melanjutkan.")
 
+class UpdateBacklog:
+    # Updates the webhook accepted that are not fully processed yet. PTB turns every queued
+    # update into a task right away, so the length of its update queue says nothing.
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+
+    def full(self):
+        return self.count >= self.limit
+
+    def add(self):
+        self.count += 1
+
+    def done(self):
+        self.count -= 1
+
+webhook_backlog = UpdateBacklog(WEBHOOK_QUEUE_SIZE)
+
+async def telegram_webhook(request):
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    application = request.app['application']
+    if webhook_backlog.full():
+        # Telegram redelivers updates answered with an error, which throttles it while we catch up
+        return web.Response(status=503)
+    webhook_backlog.add()
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+web_runner = None
+
+async def start_web_server(application):
+    global web_runner
+    app = web.Application()
+    app['application'] = application
+    app['bot'] = application.bot
+    app.add_routes(routes)
+    if BOT_MODE == 'webhook':
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    if DRIVE_PUSH_ENABLED:
+        app.router.add_post(DRIVE_PUSH_PATH, drive_notification)
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, SERVER_BIND_ADDRESS, REDIRECT_PORT).start()
+    logger.info(f"Web server listening on {SERVER_BIND_ADDRESS}:{REDIRECT_PORT}")
+
+async def stop_web_server():
+    if web_runner is not None:
+        await web_runner.cleanup()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Selamat datang! Gunakan /login untuk login ke Google Drive Anda."
@@ -82,12 +212,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def login(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    flow = create_flow(state=str(user_id))
+    old_state, _ = pending_login_for_user(user_id)
+    if old_state:
+        del pending_logins[old_state]
+    state = secrets.token_urlsafe(24)
+    flow = create_flow(state=state)
     auth_url, _ = flow.authorization_url(prompt='consent', access_type='offline', include_granted_scopes='true')
+    pending_logins[state] = PendingLogin(user_id, update.effective_chat.id, flow)
     await update.message.reply_text(
         f"Silakan klik link berikut untuk login:\n{auth_url}\n\n"
-        "Setelah login, Anda akan diarahkan ke halaman yang mengatakan login berhasil.\n"
-        "Salin kode 'code' dari URL dan kirim ke bot dengan perintah /auth <kode>."
+        "Setelah login, bot akan otomatis memberi tahu Anda di sini.\n"
+        "Jika tidak ada pemberitahuan, salin kode 'code' dari URL dan kirim ke bot dengan perintah /auth <kode>."
     )
 
 async def auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -96,18 +231,13 @@ async def auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Gunakan perintah: /auth <kode>")
         return
     code = context.args[0]
-    flow = create_flow(state=str(user_id))
+    state, pending = pending_login_for_user(user_id)
+    if pending is None:
+        await update.message.reply_text("Tidak ada login yang sedang berlangsung. Gunakan /login terlebih dahulu.")
+        return
+    del pending_logins[state]
     try:
-        flow.fetch_token(code=code)
-        creds = flow.credentials
-        sessions[str(user_id)] = {
-            'token': creds.token,
-            'refresh_token': creds.refresh_token,
-            'token_uri': creds.token_uri,
-            'client_id': creds.client_id,
-            'client_secret': creds.client_secret,
-            'scopes': creds.scopes
-        }
+        await complete_login(user_id, pending.flow, code)
         await update.message.reply_text("Login berhasil! Anda sekarang dapat mengupload file.")
     except Exception as e:
         logger.error(f"Error fetching token: {e}")
@@ -115,115 +245,1313 @@ async def auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if str(user_id) in sessions:
-        del sessions[str(user_id)]
-        if str(user_id) in files:
-            del files[str(user_id)]
+    state = await storage.user(user_id)
+    if state.session:
+        # Uploads waiting for a name still need the token to delete their temporary files
+        queue = pending_uploads(context)
+        for pending in list(queue):
+            await pending.abandon()
+        queue.clear()
+        client = await get_drive_client(user_id)
+        if client is not None:
+            await sync_engine.stop_channel(state, client)
+        storage.delete_user(state)
+        tokens.forget(user_id)
+        quotas.forget(user_id)
         await update.message.reply_text("Logout berhasil.")
     else:
         await update.message.reply_text("Anda belum login.")
 
-def load_credentials(user_id):
-    data = sessions.get(str(user_id))
-    if not data:
-        return None
-    creds = Credentials(
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '300'))      # refresh this many seconds before expiry
+TOKEN_IDLE_TIMEOUT = int(os.getenv('TOKEN_IDLE_TIMEOUT', '1800'))        # stop renewing for users idle this long
+
+def credentials_to_dict(creds):
+    return {
+        'token': creds.token,
+        'refresh_token': creds.refresh_token,
+        'token_uri': creds.token_uri,
+        'client_id': creds.client_id,
+        'client_secret': creds.client_secret,
+        'scopes': creds.scopes,
+        'expiry': creds.expiry.isoformat() if creds.expiry else None,
+    }
+
+def credentials_from_dict(data):
+    return Credentials(
         token=data.get('token'),
         refresh_token=data.get('refresh_token'),
         token_uri=data.get('token_uri'),
         client_id=data.get('client_id'),
         client_secret=data.get('client_secret'),
-        scopes=data.get('scopes')
+        scopes=data.get('scopes'),
+        expiry=datetime.datetime.fromisoformat(data['expiry']) if data.get('expiry') else None,
     )
-    if creds.expired and creds.refresh_token:
+
+class TokenManager:
+    # Keeps live Credentials for active users. Concurrent refreshes for one user share a
+    # single in-flight request, and tokens are renewed in the background shortly before
+    # they expire while the user keeps using the bot.
+    def __init__(self):
+        self._creds = {}      # user_id -> Credentials
+        self._last_used = {}  # user_id -> monotonic time of last get()
+        self._inflight = {}   # user_id -> future of the running refresh
+        self._timers = {}     # user_id -> TimerHandle of the proactive refresh
+        self.refreshes = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.proactive = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def get(self, user_id):
+        key = str(user_id)
+        creds = self._creds.get(key)
+        if creds is None:
+            data = (await storage.user(key)).session
+            if not data:
+                return None
+            creds = self._creds.setdefault(key, credentials_from_dict(data))
+            self._schedule(key, creds)
+        self._last_used[key] = time.monotonic()
+        if self._needs_refresh(creds):
+            try:
+                await self.refresh(key)
+            except RefreshError:
+                # Google rejected the refresh token, the user has to log in again
+                return None
+            except Exception as e:
+                raise TokenUnavailable(key) from e
+        return self._creds.get(key)
+
+    async def set(self, user_id, creds):
+        key = str(user_id)
+        self._creds[key] = creds
+        self._last_used[key] = time.monotonic()
+        storage.set_session(await storage.user(key), credentials_to_dict(creds))
+        self._schedule(key, creds)
+
+    def forget(self, user_id):
+        key = str(user_id)
+        self._creds.pop(key, None)
+        self._last_used.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    @staticmethod
+    def _needs_refresh(creds):
+        return bool(creds.refresh_token) and (not creds.token or creds.expired)
+
+    async def refresh(self, user_id, rejected_token=None):
+        key = str(user_id)
+        creds = self._creds.get(key)
+        if creds is None:
+            raise RuntimeError(f"No credentials loaded for user {key}")
+        # Another request may already have replaced the rejected token
+        if rejected_token is not None and creds.token != rejected_token:
+            return creds
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = self._inflight[key] = asyncio.ensure_future(self._do_refresh(key, creds))
+        return await asyncio.shield(future)
+
+    async def _do_refresh(self, key, creds):
+        started = time.monotonic()
+        try:
+            await io_executor.run(key, creds.refresh, Request())
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Failed to refresh token for user {key}: {e}")
+            raise
+        finally:
+            del self._inflight[key]
+        latency = time.monotonic() - started
+        self.refreshes += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if self._creds.get(key) is creds:
+            storage.set_session(await storage.user(key), credentials_to_dict(creds))
+            self._schedule(key, creds)
+        return creds
+
+    def _schedule(self, key, creds):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not creds.expiry or not creds.refresh_token:
+            return
+        delay = (creds.expiry - datetime.datetime.utcnow()).total_seconds() - TOKEN_REFRESH_MARGIN
+        loop = asyncio.get_running_loop()
+        self._timers[key] = loop.call_later(max(delay, 0), lambda: asyncio.ensure_future(self._renew(key)))
+
+    async def _renew(self, key):
+        self._timers.pop(key, None)
+        if time.monotonic() - self._last_used.get(key, 0) > TOKEN_IDLE_TIMEOUT:
+            # Idle users are dropped and refreshed on demand when they come back
+            self._creds.pop(key, None)
+            self._last_used.pop(key, None)
+            return
+        self.proactive += 1
         try:
-            creds.refresh(Request())
-            # Update session with refreshed token
-            sessions[str(user_id)] = {
-                'token': creds.token,
-                'refresh_token': creds.refresh_token,
-                'token_uri': creds.token_uri,
-                'client_id': creds.client_id,
-                'client_secret': creds.client_secret,
-                'scopes': creds.scopes
+            await self.refresh(key)
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            'users': len(self._creds),
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'coalesced': self.coalesced,
+            'proactive': self.proactive,
+            'avg_latency': self.total_latency / self.refreshes if self.refreshes else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+tokens = TokenManager()
+
+async def get_drive_client(user_id):
+    # Clients only carry the user id, tokens live in the token manager, so they are not cached
+    if not await tokens.get(user_id):
+        return None
+    return DriveClient(user_id, tokens)
+
+QUOTA_TTL = int(os.getenv('QUOTA_TTL', '300'))
+
+class QuotaCache:
+    # Per-user Drive storage quota from about.get. Uploads are checked against the cached
+    # figure and subtract their size locally; a stale entry is still used while a refresh
+    # runs in the background, so only a user's very first check waits on Drive.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}     # user_id -> {'limit': bytes or None, 'usage': bytes, 'fetched': monotonic}
+        self._refreshing = {}  # user_id -> task
+
+    async def _fetch(self, user_id, client):
+        try:
+            about = await client.about('storageQuota(limit, usage)')
+            quota = about.get('storageQuota', {})
+            limit = int(quota['limit']) if quota.get('limit') else None  # no limit on unlimited plans
+            self._entries[user_id] = {
+                'limit': limit, 'usage': int(quota.get('usage', 0)), 'fetched': time.monotonic(),
             }
         except Exception as e:
-            logger.error(f"Failed to refresh token for user {user_id}: {e}")
+            logger.warning(f"Could not fetch Drive quota for user {user_id}: {e}")
+        finally:
+            self._refreshing.pop(user_id, None)
+
+    def _refresh(self, user_id, client):
+        if user_id not in self._refreshing:
+            self._refreshing[user_id] = asyncio.create_task(self._fetch(user_id, client))
+        return self._refreshing[user_id]
+
+    async def remaining(self, user_id, client):
+        # Free bytes, or None if unlimited or unknown
+        key = str(user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            await asyncio.shield(self._refresh(key, client))
+            entry = self._entries.get(key)
+        elif time.monotonic() - entry['fetched'] > self.ttl:
+            self._refresh(key, client)
+        if entry is None or entry['limit'] is None:
             return None
-    return creds
+        return entry['limit'] - entry['usage']
+
+    def consume(self, user_id, size):
+        # Negative sizes give space back, e.g. after deleting an upload
+        entry = self._entries.get(str(user_id))
+        if entry is not None and size:
+            entry['usage'] = max(0, entry['usage'] + size)
+
+    def mark_stale(self, user_id):
+        # For changes whose size we do not know; the next check refreshes in the background
+        entry = self._entries.get(str(user_id))
+        if entry is not None:
+            entry['fetched'] = float('-inf')
+
+    def forget(self, user_id):
+        self._entries.pop(str(user_id), None)
+
+quotas = QuotaCache(QUOTA_TTL)
+
+SYNC_ENABLED = os.getenv('SYNC_ENABLED', 'true').lower() != 'false'
+SYNC_INTERVAL = int(os.getenv('SYNC_INTERVAL', '60'))  # without push, sync a user at most this often
+SYNC_FILE_FIELDS = 'id, name, mimeType, md5Checksum, trashed'
+PENDING_NAME_PREFIX = '[pending] '
+
+# DRIVE_PUSH_ENABLED=true asks Drive to POST change notifications to the web server instead
+# of polling; the domain in DRIVE_PUSH_URL must be verified for the Google project
+DRIVE_PUSH_ENABLED = os.getenv('DRIVE_PUSH_ENABLED', '').lower() in ('1', 'true', 'yes')
+DRIVE_PUSH_PATH = os.getenv('DRIVE_PUSH_PATH', '/drive/changes')
+DRIVE_PUSH_URL = os.getenv('DRIVE_PUSH_URL', f'https://{REDIRECT_HOST}{DRIVE_PUSH_PATH}')
+DRIVE_PUSH_TTL = int(os.getenv('DRIVE_PUSH_TTL', str(24 * 3600)))
+DRIVE_PUSH_RETRY = int(os.getenv('DRIVE_PUSH_RETRY', '600'))
+DRIVE_PUSH_SECRET = os.getenv(
+    'DRIVE_PUSH_SECRET', hashlib.sha256(f'drive-push:{TELEGRAM_TOKEN}'.encode()).hexdigest()
+)
+
+class SyncEngine:
+    # Keeps each user's file index in line with Drive, so files renamed or deleted in the
+    # Drive UI show up correctly. The first sync lists the app's files once with a field
+    # mask; after that only changes.list is read from the saved page token, so a refresh
+    # costs as much as what changed. With push enabled a changes.watch channel says when
+    # to sync instead of polling whenever the index is read.
+    def __init__(self):
+        self._running = {}     # user_id -> sync task, so concurrent callers share one
+        self._synced_at = {}   # user_id -> monotonic time of the last sync
+        self._dirty = set()    # users notified of changes not synced yet
+        self._watch_retry = {}  # user_id -> monotonic time before which watch is not retried
+        self.bootstraps = 0
+        self.syncs = 0
+        self.changes = 0
+        self.notifications = 0
+
+    async def ensure_fresh(self, state, client):
+        # Called before the user's index is read
+        if not SYNC_ENABLED:
+            return
+        key = state.user_id
+        if 'changes_token' not in state.settings or key in self._dirty:
+            needed = True
+        elif DRIVE_PUSH_ENABLED and self._channel_active(state):
+            needed = False
+        else:
+            needed = time.monotonic() - self._synced_at.get(key, float('-inf')) > SYNC_INTERVAL
+        if needed:
+            try:
+                await self.sync(state, client)
+            except Exception as e:
+                logger.error(f"Drive sync failed for user {key}: {e}")
+                return
+        if DRIVE_PUSH_ENABLED and not self._channel_active(state):
+            await self._watch(state, client)
+
+    def sync(self, state, client):
+        key = state.user_id
+        if key not in self._running:
+            storage.pin(key)
+            task = self._running[key] = asyncio.ensure_future(self._sync(state, client))
+            task.add_done_callback(lambda _: (self._running.pop(key, None), storage.unpin(key)))
+        return asyncio.shield(self._running[key])
+
+    async def _sync(self, state, client):
+        self._dirty.discard(state.user_id)
+        pending = dict(state.settings.get('pending_files', {}))  # unnamed speculative uploads -> time first seen
+        token = state.settings.get('changes_token')
+        if token is not None:
+            try:
+                token = await self._apply_changes(state, client, token, pending)
+            except DriveError as e:
+                if e.status not in (400, 404):
+                    raise
+                logger.warning(f"Change token for user {state.user_id} rejected ({e}), listing files again")
+                token = None
+        if token is None:
+            token = await self._bootstrap(state, client, pending)
+        if state.user_id not in self._synced_at:
+            # Earlier versions indexed album folders as files
+            for record in [r for r in state.files if r.get('mime_type') == DRIVE_FOLDER_MIME_TYPE]:
+                storage.remove_file(state, record)
+        await self._delete_stale_pending(state, client, pending)
+        storage.set_settings(state, {**state.settings, 'changes_token': token, 'pending_files': pending})
+        self._synced_at[state.user_id] = time.monotonic()
+        self.syncs += 1
+
+    async def _bootstrap(self, state, client, pending):
+        # Take the token first, so whatever changes while we list is replayed next time
+        token = await client.start_page_token()
+        found = {}
+        page_token = None
+        while True:
+            page = await client.list(
+                q=f"trashed = false and mimeType != '{DRIVE_FOLDER_MIME_TYPE}'", page_token=page_token, page_size=1000, order_by='createdTime',
+                fields=f'nextPageToken, files({SYNC_FILE_FIELDS})',
+            )
+            for f in page.get('files', []):
+                found[f['id']] = f
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                break
+        for record in list(state.files):
+            if record['id'] not in found:
+                storage.remove_file(state, record)
+        for file_id in list(pending):
+            if file_id not in found:
+                del pending[file_id]
+        for f in found.values():
+            self._apply_file(state, f, pending)
+        self.bootstraps += 1
+        logger.info(f"Indexed {len(found)} Drive files for user {state.user_id}")
+        return token
+
+    async def _apply_changes(self, state, client, token, pending):
+        while True:
+            page = await client.changes(
+                token, fields=f'nextPageToken, newStartPageToken, changes(fileId, removed, file({SYNC_FILE_FIELDS}))'
+            )
+            for change in page.get('changes', []):
+                if change.get('removed') or not change.get('file'):
+                    self._forget_file(state, change['fileId'], pending)
+                else:
+                    self._apply_file(state, {**change['file'], 'id': change['fileId']}, pending)
+                self.changes += 1
+            if 'newStartPageToken' in page:
+                return page['newStartPageToken']
+            token = page['nextPageToken']
+
+    def _apply_file(self, state, f, pending):
+        record = state.ids.get(f['id'])
+        if f.get('trashed') or f.get('mimeType') == DRIVE_FOLDER_MIME_TYPE:
+            # Album folders are not files: they have no content to send, and deleting
+            # one would delete the whole album
+            self._forget_file(state, f['id'], pending)
+        elif record is None and f['name'].startswith(PENDING_NAME_PREFIX):
+            # Speculative uploads record themselves once the user has named them; until
+            # then they are only remembered, in case nobody ever names them
+            pending.setdefault(f['id'], time.time())
+        elif record is None:
+            pending.pop(f['id'], None)
+            record_upload(state, {
+                'id': f['id'], 'name': f['name'], 'mime_type': f.get('mimeType'), 'md5': f.get('md5Checksum'),
+            })
+        elif record['name'] != f['name']:
+            record['name'] = f['name']
+            if not telegram_copy_usable(record):
+                forget_telegram_copy(record)
+            storage.update_file(state, record)
+
+    def _forget_file(self, state, file_id, pending):
+        pending.pop(file_id, None)
+        record = state.ids.get(file_id)
+        if record is not None:
+            storage.remove_file(state, record)
+
+    async def _delete_stale_pending(self, state, client, pending):
+        # Speculative uploads only live in memory. One still unnamed SPECULATIVE_UPLOAD_TIMEOUT
+        # after it appeared was abandoned without being cleaned up, e.g. by a restart, and
+        # would keep using quota where the user can neither see nor delete it.
+        cutoff = time.time() - SPECULATIVE_UPLOAD_TIMEOUT
+        for file_id, seen in list(pending.items()):
+            if seen > cutoff:
+                continue
+            try:
+                await client.delete(file_id)
+            except DriveError as e:
+                if e.status != 404:
+                    logger.warning(f"Could not delete stale pending upload {file_id}: {e}")
+                    continue
+            del pending[file_id]
+            quotas.mark_stale(state.user_id)
+            logger.info(f"Deleted stale pending upload {file_id} of user {state.user_id}")
+
+    def _channel_active(self, state):
+        channel = state.settings.get('changes_channel')
+        return channel is not None and channel['expiration'] > time.time() + 60
+
+    def channel_signature(self, user_id):
+        return hmac.new(DRIVE_PUSH_SECRET.encode(), str(user_id).encode(), hashlib.sha256).hexdigest()
+
+    async def _watch(self, state, client):
+        key = state.user_id
+        if 'changes_token' not in state.settings or time.monotonic() < self._watch_retry.get(key, 0):
+            return
+        channel_id = secrets.token_hex(16)
+        try:
+            channel = await client.watch_changes(
+                state.settings['changes_token'], channel_id, DRIVE_PUSH_URL,
+                f"{key}:{self.channel_signature(key)}", int((time.time() + DRIVE_PUSH_TTL) * 1000),
+            )
+        except Exception as e:
+            logger.warning(f"Could not open a Drive change channel for user {key}: {e}")
+            self._watch_retry[key] = time.monotonic() + DRIVE_PUSH_RETRY
+            return
+        storage.set_settings(state, {
+            **state.settings,
+            'changes_channel': {
+                'id': channel_id, 'resource_id': channel['resourceId'],
+                'expiration': int(channel['expiration']) / 1000,
+            },
+        })
+
+    async def stop_channel(self, state, client):
+        channel = state.settings.get('changes_channel')
+        if channel is None:
+            return
+        try:
+            await client.stop_channel(channel['id'], channel['resource_id'])
+        except Exception as e:
+            logger.warning(f"Could not stop Drive change channel {channel['id']}: {e}")
+
+    def notify(self, user_id):
+        self.notifications += 1
+        key = str(user_id)
+        self._dirty.add(key)
+        if key not in self._running:
+            asyncio.create_task(self._sync_notified(key))
+
+    async def _sync_notified(self, key):
+        try:
+            client = await get_drive_client(key)
+            if client is None:
+                return
+            await self.sync(await storage.user(key), client)
+        except Exception as e:
+            logger.error(f"Drive sync failed for user {key}: {e}")
+
+    def stats(self):
+        return {
+            'bootstraps': self.bootstraps, 'syncs': self.syncs, 'changes': self.changes,
+            'notifications': self.notifications,
+        }
+
+sync_engine = SyncEngine()
+
+async def drive_notification(request):
+    channel_token = request.headers.get('X-Goog-Channel-Token', '')
+    user_id, _, signature = channel_token.partition(':')
+    if not user_id or not hmac.compare_digest(signature, sync_engine.channel_signature(user_id)):
+        return web.Response(status=403)
+    # The first message on a channel only confirms it was created
+    if request.headers.get('X-Goog-Resource-State') != 'sync':
+        sync_engine.notify(user_id)
+    return web.Response()
+
+spool_sweeper = None
+
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'true').lower() != 'false'
+
+class DedupIndex:
+    # Finds an earlier upload of the same content by Telegram file_unique_id or MD5. The
+    # keys live on each UserState, built when the user is loaded and kept up to date by
+    # Storage, so a lookup is a dict access and nothing is loaded up front.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lookups = 0
+        self.hits = 0
+
+    def find(self, state, unique_id=None, md5=None):
+        if not self.enabled:
+            return None
+        for keys, value in ((state.by_unique_id, unique_id), (state.by_md5, md5)):
+            if not value:
+                continue
+            self.lookups += 1
+            records = keys.get(value)
+            if records:
+                self.hits += 1
+                return records[-1]
+        return None
+
+    def stats(self):
+        return {'lookups': self.lookups, 'hits': self.hits}
+
+dedup = DedupIndex(DEDUP_ENABLED)
+
+async def local_file_md5(user_id, path):
+    source = LocalFileSource(user_id, path)
+    digest = hashlib.md5()
+    try:
+        while True:
+            chunk, eof = await source.read(UPLOAD_CHUNK_SIZE)
+            digest.update(chunk)
+            if eof:
+                return digest.hexdigest()
+    finally:
+        source.close()
+
+def telegram_file_fields(file_id, telegram_type, unique_id=None, name=None):
+    # Kept on the file record so /get can resend the file by id instead of streaming it,
+    # and so a second copy of the same Telegram file is recognised. `name` is the file
+    # name Telegram has for that copy.
+    fields = {'telegram_file_id': file_id, 'telegram_type': telegram_type, 'telegram_name': name}
+    if unique_id:
+        fields['telegram_unique_id'] = unique_id
+    return fields
+
+def telegram_copy_usable(record):
+    # A document resent by file_id keeps the name it was first sent under, so the cached
+    # copy only fits while the record still has that name. Photos carry no file name.
+    if not record.get('telegram_file_id'):
+        return False
+    return record.get('telegram_type') == 'photo' or record.get('telegram_name') == record['name']
+
+def forget_telegram_copy(record):
+    for key in ('telegram_file_id', 'telegram_type', 'telegram_name'):
+        record.pop(key, None)
+
+def record_upload(state, record):
+    existing = state.ids.get(record['id'])
+    if existing is not None:
+        # Drive sync saw the new file before the upload that made it got here
+        existing.update(record)
+        storage.update_file(state, existing)
+        record = existing
+    else:
+        storage.add_file(state, record)
+    return record
+
+async def still_on_drive(client, state, record):
+    # The index can lag behind Drive, e.g. for a file deleted in the Drive UI since the
+    # last sync, so an earlier upload is checked before it stands in for a new one.
+    # A record that is gone is dropped from the index.
+    try:
+        metadata = await client.get(record['id'], fields='id, trashed')
+    except DriveError as e:
+        if e.status != 404:
+            raise
+        metadata = None
+    if metadata is None or metadata.get('trashed'):
+        logger.info(f"Duplicate {record['id']} no longer on Drive")
+        storage.remove_file(state, record)
+        return False
+    return True
+
+async def redundant_upload(client, state, md5, file_name, parents=None):
+    # Whether a finished upload only repeats a file already on Drive under the same name
+    original = dedup.find(state, md5=md5)
+    if original is None or original['name'] != file_name or parents:
+        return False
+    try:
+        return await still_on_drive(client, state, original)
+    except Exception as e:
+        logger.warning(f"Could not check {original['id']} on Drive, keeping the new upload of {file_name}: {e}")
+        return False
+
+async def reuse_duplicate(client, state, original, file_name, record_fields, parents=None):
+    # Stores `file_name` without transferring its bytes again: nothing to do if the
+    # existing upload already has that name, otherwise a server-side copy. Returns the
+    # status text, or None if the original is gone from Drive and a real upload is needed.
+    if original['name'] == file_name and not parents:
+        if not await still_on_drive(client, state, original):
+            return None
+        return f"File '{file_name}' sudah ada di Google Drive, tidak diupload ulang."
+    try:
+        copied = await client.copy(original['id'], file_name, fields='id, name, size', parents=parents)
+    except DriveError as e:
+        if e.status != 404:
+            raise
+        logger.info(f"Duplicate {original['id']} no longer on Drive, uploading {file_name} again")
+        storage.remove_file(state, original)
+        return None
+    record_upload(state, {
+        **record_fields, 'id': copied['id'], 'name': file_name, 'mime_type': original.get('mime_type'),
+        'md5': original.get('md5'),
+    })
+    quotas.consume(state.user_id, int(copied.get('size', 0)))
+    return f"File '{file_name}' disalin dari '{original['name']}' di Google Drive tanpa upload ulang."
+
+async def preflight_upload(user_id, client, size):
+    # Why an upload of `size` bytes is bound to fail, checked before any byte moves; None if it may go ahead
+    if not size:
+        return None
+    return download_refusal(size) or await quota_refusal(user_id, client, size)
+
+def download_refusal(size):
+    if size and TELEGRAM_DOWNLOAD_LIMIT is not None and size > TELEGRAM_DOWNLOAD_LIMIT:
+        return f"File terlalu besar untuk diunduh bot dari Telegram (maksimal {TELEGRAM_DOWNLOAD_LIMIT // MB} MB)."
+    return None
+
+async def quota_refusal(user_id, client, size):
+    if not size:
+        return None
+    remaining = await quotas.remaining(user_id, client)
+    if remaining is not None and size > remaining:
+        return (
+            f"Ruang Google Drive tidak cukup: file {format_size(size)}, "
+            f"sisa ruang {format_size(max(remaining, 0))}."
+        )
+    return None
+
+async def transfer_telegram_file(bot, client, user_id, file_id, file_name, mime_type, record_fields, progress=None,
+                                 parents=None):
+    # Streams one Telegram file into Drive and records it; returns the status text
+    file_obj = await bot.get_file(file_id)
+    state = await storage.user(user_id)
+    if is_local_file_path(file_obj.file_path):
+        # Hashing a file the local Bot API server already wrote is cheap next to uploading it
+        original = dedup.find(state, md5=await local_file_md5(user_id, file_obj.file_path))
+        if original is not None:
+            text = await reuse_duplicate(client, state, original, file_name, record_fields, parents)
+            if text is not None:
+                return text
+    uploaded_file = await stream_upload_to_drive(
+        client, file_obj.file_path, file_name, mime_type, file_obj.file_size, progress=progress, parents=parents
+    )
+    md5 = uploaded_file.get('md5Checksum')
+    if await redundant_upload(client, state, md5, file_name, parents):
+        await client.delete(uploaded_file['id'])
+        return f"File '{file_name}' sudah ada di Google Drive, salinan baru dihapus."
+    record_upload(state, {
+        'id': uploaded_file['id'], 'name': file_name, 'mime_type': mime_type, 'md5': md5, **record_fields,
+    })
+    quotas.consume(user_id, file_obj.file_size)
+    return f"File '{file_name}' berhasil diupload ke Google Drive."
+
+async def upload_telegram_file(update, context, client, file_id, file_name, mime_type, size=None,
+                               telegram_type='document', unique_id=None, telegram_name=None):
+    user_id = update.effective_user.id
+    record_fields = telegram_file_fields(file_id, telegram_type, unique_id, telegram_name)
+
+    state = await storage.user(user_id)
+    original = dedup.find(state, unique_id=unique_id)
+    if original is not None:
+        try:
+            text = await reuse_duplicate(client, state, original, file_name, record_fields)
+        except Exception as e:
+            logger.error(f"Error reusing {original['id']} as {file_name}: {e}")
+            await update.message.reply_text("Gagal menyalin file.")
+            return False
+        if text is not None:
+            await update.message.reply_text(text)
+            return True
+
+    async def run(job):
+        return await transfer_telegram_file(
+            context.bot, client, user_id, file_id, file_name, mime_type, record_fields, job.set_progress
+        )
+
+    # The spool holds up to one RAM buffer plus the chunk being sent, and spills the rest
+    job = TransferJob(
+        user_id, 'upload', file_name, size, run, "Gagal mengupload file.",
+        memory=UPLOAD_BUFFER_SIZE + UPLOAD_CHUNK_SIZE, disk=spool_reservation(size, UPLOAD_BUFFER_SIZE),
+    )
+    return await scheduler.submit(update.message, job)
+
+ALBUM_DEBOUNCE = float(os.getenv('ALBUM_DEBOUNCE', '1.5'))
+ALBUM_PARALLELISM = int(os.getenv('ALBUM_PARALLELISM', '3'))
+# ALBUM_FOLDERS=true puts every album in its own Drive folder, named by the album caption
+ALBUM_FOLDERS = os.getenv('ALBUM_FOLDERS', '').lower() in ('1', 'true', 'yes')
+
+class Album:
+    def __init__(self, message, bot, client):
+        self.message = message  # first item, the summary replies to it
+        self.bot = bot
+        self.client = client
+        self.items = []
+        self.caption = None
+        self.timer = None
+
+class AlbumCollector:
+    # Telegram delivers an album as one update per item sharing a media_group_id, with no
+    # marker on the last one. Items are collected until none has arrived for
+    # ALBUM_DEBOUNCE seconds and then uploaded together as one transfer job.
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self._albums = {}  # (user_id, media_group_id) -> Album
+
+    def add(self, update, context, client, item):
+        key = (update.effective_user.id, update.message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = Album(update.message, context.bot, client)
+        album.items.append(item)
+        if item['caption'] and album.caption is None:
+            album.caption = item['caption']
+        if album.timer is not None:
+            album.timer.cancel()
+        album.timer = asyncio.get_running_loop().call_later(
+            self.debounce, lambda: asyncio.ensure_future(self._flush(key))
+        )
+
+    async def _flush(self, key):
+        album = self._albums.pop(key, None)
+        if album is None:
+            return
+        try:
+            with storage.pinned(key[0]):
+                await upload_album(key[0], album)
+        except Exception as e:
+            logger.error(f"Error uploading album {key[1]} for user {key[0]}: {e}")
+
+albums = AlbumCollector(ALBUM_DEBOUNCE)
+
+async def upload_album(user_id, album):
+    client = album.client
+    state = await storage.user(user_id)
+    when = album.message.date.astimezone()
+    folder_name = (album.caption or f"Album {when:%Y-%m-%d %H.%M}") if ALBUM_FOLDERS else None
+    # Items are checked here rather than in handle_file, so the album gets one reply
+    too_large = [item['caption'] or item['original_name'] for item in album.items if download_refusal(item['size'])]
+    named = []
+    for item in album.items:
+        if download_refusal(item['size']):
+            continue
+        if item['caption'] and not ALBUM_FOLDERS:
+            name = item['caption']
+        else:
+            name = auto_file_name(state, item['original_name'], when) or item['original_name']
+        named.append((item, name))
+
+    def summary(failed):
+        text = f"Album: {len(named) - len(failed)} dari {len(album.items)} file berhasil diupload ke Google Drive"
+        text += f" di folder '{folder_name}'." if folder_name and named else "."
+        if too_large:
+            text += (
+                f"\nTerlalu besar untuk diunduh bot dari Telegram (maksimal {TELEGRAM_DOWNLOAD_LIMIT // MB} MB): "
+                + ", ".join(f"'{name}'" for name in too_large)
+            )
+        if failed:
+            text += "\nGagal: " + ", ".join(f"'{name}'" for name in failed)
+        return text
+
+    if not named:
+        await album.message.reply_text(summary([]))
+        return
+    total = sum(item['size'] or 0 for item, _ in named)
+    refusal = await quota_refusal(user_id, client, total)
+    if refusal is not None:
+        await album.message.reply_text(refusal)
+        return
+
+    async def run(job):
+        parents = [(await client.create_folder(folder_name))['id']] if folder_name else None
+        offsets = {}
+        semaphore = asyncio.Semaphore(ALBUM_PARALLELISM)
+
+        async def upload(index, item, name):
+            def progress(done):
+                offsets[index] = done
+                job.set_progress(sum(offsets.values()))
+
+            record_fields = telegram_file_fields(
+                item['file_id'], item['telegram_type'], item['unique_id'], item['original_name']
+            )
+            async with semaphore:
+                try:
+                    original = dedup.find(state, unique_id=item['unique_id'])
+                    if original is not None:
+                        if await reuse_duplicate(client, state, original, name, record_fields, parents) is not None:
+                            return None
+                    await transfer_telegram_file(
+                        album.bot, client, user_id, item['file_id'], name, item['mime_type'], record_fields,
+                        progress, parents,
+                    )
+                    return None
+                except Exception as e:
+                    logger.error(f"Error uploading album item {name}: {e}")
+                    return name
+
+        failed = [name for name in await asyncio.gather(
+            *(upload(index, item, name) for index, (item, name) in enumerate(named))
+        ) if name is not None]
+        return summary(failed)
+
+    # Up to ALBUM_PARALLELISM items stream at once, each through its own spool
+    parallel = min(ALBUM_PARALLELISM, len(named))
+    largest = max(item['size'] or 0 for item, _ in named)
+    job = TransferJob(
+        user_id, 'upload', folder_name or f"album {len(named)} file", total, run, "Gagal mengupload album.",
+        memory=parallel * (UPLOAD_BUFFER_SIZE + UPLOAD_CHUNK_SIZE),
+        disk=parallel * spool_reservation(largest or None, UPLOAD_BUFFER_SIZE),
+    )
+    await scheduler.submit(album.message, job)
+
+SPECULATIVE_UPLOAD_TIMEOUT = int(os.getenv('SPECULATIVE_UPLOAD_TIMEOUT', '600'))
 
-def get_drive_service(user_id):
-    creds = load_credentials(user_id)
-    if not creds:
+class SpeculativeUpload:
+    # A captionless file starts uploading under a temporary name right away. Whichever
+    # finishes last, the upload or the user's reply with the real name, applies the name
+    # with a metadata-only rename; a conversation that is cancelled or times out deletes
+    # the uploaded file again. A file already known by its Telegram file_unique_id is not
+    # uploaded at all (see `duplicate_of`).
+    def __init__(self, user_id, client, file_id, original_name, mime_type, size, telegram_type='document',
+                 unique_id=None):
+        self.user_id = user_id
+        self.client = client
+        self.file_id = file_id
+        self.telegram_type = telegram_type
+        self.unique_id = unique_id
+        self.original_name = original_name
+        self.mime_type = mime_type
+        self.size = size
+        self.temp_name = f"{PENDING_NAME_PREFIX}{original_name}"
+        self.duplicate_of = None    # existing record with the same content, if any
+        self.drive_file = None      # set once the upload has finished
+        self.final_name = None      # set once the user has replied
+        self.failed = False
+        self.abandoned = False
+        self._finalized = False
+        self._expiry = None
+
+    def record_fields(self):
+        return telegram_file_fields(self.file_id, self.telegram_type, self.unique_id, self.original_name)
+
+    def expire_after(self, queue, timeout=SPECULATIVE_UPLOAD_TIMEOUT):
+        def expire():
+            if self in queue:
+                queue.remove(self)
+            asyncio.ensure_future(self.abandon())
+        self._expiry = asyncio.get_running_loop().call_later(timeout, expire)
+
+    async def run(self, bot, job):
+        if self.abandoned:
+            return f"Upload '{self.original_name}' dibatalkan."
+        try:
+            file_obj = await bot.get_file(self.file_id)
+            job.size = file_obj.file_size or job.size
+            self.drive_file = await stream_upload_to_drive(
+                self.client, file_obj.file_path, self.temp_name, self.mime_type, file_obj.file_size,
+                progress=job.set_progress,
+            )
+            self.size = job.size
+            quotas.consume(self.user_id, self.size)
+        except Exception:
+            self.failed = True
+            raise
+        if self.abandoned:
+            await self._discard()
+            return f"Upload '{self.original_name}' dibatalkan."
+        if self._claim():
+            return await self._finalize()
+        return f"File '{self.original_name}' sudah diupload, menunggu nama file."
+
+    async def set_name(self, file_name):
+        # Returns the status text if the name could be applied right away, None if the
+        # upload is still running and will apply it when it finishes.
+        self.final_name = file_name
+        if self._expiry is not None:
+            # Answered in time; the name is applied whenever the upload finishes
+            self._expiry.cancel()
+        if self._claim():
+            return await self._finalize()
         return None
-    return build('drive', 'v3', credentials=creds)
+
+    def _claim(self):
+        if self.drive_file is None or self.final_name is None or self._finalized:
+            return False
+        self._finalized = True
+        if self._expiry is not None:
+            self._expiry.cancel()
+        return True
+
+    async def _finalize(self):
+        state = await storage.user(self.user_id)
+        md5 = self.drive_file.get('md5Checksum')
+        if await redundant_upload(self.client, state, md5, self.final_name):
+            await self._discard()
+            return f"File '{self.final_name}' sudah ada di Google Drive, salinan baru dihapus."
+        await self.client.update(self.drive_file['id'], {'name': self.final_name})
+        record_upload(state, {
+            'id': self.drive_file['id'], 'name': self.final_name, 'mime_type': self.mime_type, 'md5': md5,
+            **self.record_fields(),
+        })
+        return f"File '{self.final_name}' berhasil diupload ke Google Drive."
+
+    async def abandon(self):
+        if self._finalized or self.abandoned:
+            return
+        self.abandoned = True
+        if self._expiry is not None:
+            self._expiry.cancel()
+        if self.drive_file is not None:
+            await self._discard()
+
+    async def _discard(self):
+        try:
+            await self.client.delete(self.drive_file['id'])
+            quotas.consume(self.user_id, -(self.size or 0))
+        except Exception as e:
+            logger.error(f"Error deleting abandoned upload {self.drive_file['id']}: {e}")
+
+async def start_speculative_upload(update, context, client, file_id, original_name, mime_type, size=None,
+                                   telegram_type='document', unique_id=None):
+    user_id = update.effective_user.id
+    pending = SpeculativeUpload(user_id, client, file_id, original_name, mime_type, size, telegram_type, unique_id)
+    pending.duplicate_of = dedup.find(await storage.user(user_id), unique_id=unique_id)
+    if pending.duplicate_of is None:
+        job = TransferJob(
+            user_id, 'upload', original_name, size, functools.partial(pending.run, context.bot),
+            "Gagal mengupload file.",
+            memory=UPLOAD_BUFFER_SIZE + UPLOAD_CHUNK_SIZE, disk=spool_reservation(size, UPLOAD_BUFFER_SIZE),
+        )
+        if not await scheduler.submit(update.message, job):
+            pending.failed = True
+    pending.expire_after(pending_uploads(context))
+    return pending
+
+def pending_uploads(context):
+    # Captionless files waiting for a name, in the order they arrived
+    return context.user_data.setdefault('pending_uploads', deque())
+
+NAMING_RULES = {
+    'ask': "tanya nama file setiap kali",
+    'original': "pakai nama asli file",
+    'timestamp': "nama dari template waktu",
+    'counter': "awalan dengan nomor urut",
+}
+DEFAULT_TIMESTAMP_TEMPLATE = '{name}_%Y%m%d_%H%M%S{ext}'
+
+TEMPLATE_PLACEHOLDER = re.compile(r'\{(name|ext)\}')
+
+def render_timestamp_name(template, original_name, when):
+    # Templates are user input, so only the literal {name} and {ext} are substituted;
+    # str.format would also allow attribute lookups and arbitrary padding widths
+    rest = TEMPLATE_PLACEHOLDER.sub('', template)
+    if '{' in rest or '}' in rest:
+        raise ValueError(f"Unsupported placeholder in {template!r}")
+    name, ext = os.path.splitext(original_name)
+    parts = {'name': name, 'ext': ext}
+    return TEMPLATE_PLACEHOLDER.sub(lambda match: parts[match.group(1)], when.strftime(template))
+
+def auto_file_name(state, original_name, when):
+    # Name for a captionless file under the user's naming rule, None to ask the user
+    settings = state.settings
+    rule = settings.get('naming', 'ask')
+    if rule == 'original':
+        return original_name
+    if rule == 'timestamp':
+        try:
+            return render_timestamp_name(settings.get('template', DEFAULT_TIMESTAMP_TEMPLATE), original_name, when)
+        except ValueError:
+            # Saved before templates were restricted to {name} and {ext}
+            return render_timestamp_name(DEFAULT_TIMESTAMP_TEMPLATE, original_name, when)
+    if rule == 'counter':
+        counter = settings.get('counter', 0) + 1
+        storage.set_settings(state, {**settings, 'counter': counter})
+        return f"{settings['prefix']}_{counter}{os.path.splitext(original_name)[1]}"
+    return None
+
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '10'))
+LIST_CACHE_SIZE = int(os.getenv('LIST_CACHE_SIZE', '1024'))
+
+class ListPageCache:
+    # Rendered /list pages per (user, page). Entries carry the user's file list version,
+    # so any upload, rename or delete invalidates them without explicit bookkeeping.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._pages = OrderedDict()  # (user_id, page) -> (version, text, markup)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, state, page):
+        key = (state.user_id, page)
+        entry = self._pages.get(key)
+        if entry is not None and entry[0] == state.version:
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+        self.misses += 1
+        text, markup = render_list_page(state, page)
+        self._pages[key] = (state.version, text, markup)
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+        return text, markup
+
+    def __len__(self):
+        return len(self._pages)
+
+list_pages = ListPageCache(LIST_CACHE_SIZE)
+
+def page_count(state):
+    return max(1, -(-len(state.files) // LIST_PAGE_SIZE))
+
+def render_list_page(state, page):
+    # Only the records on this page are touched. Every button names the list's owner, so
+    # in a group only they can use it.
+    owner = state.user_id
+    start = page * LIST_PAGE_SIZE
+    lines = [f"File yang sudah Anda upload (halaman {page + 1}/{page_count(state)}):"]
+    buttons = []
+    for idx, f in enumerate(state.files[start:start + LIST_PAGE_SIZE], start=start + 1):
+        mime = f.get('mime_type', 'unknown')
+        lines.append(f"{idx}. {f['name']} ({mime})")
+        buttons.append([
+            InlineKeyboardButton(f"Unduh {idx}", callback_data=f"get:{owner}:{f['seq']}:{page}"),
+            InlineKeyboardButton(f"Hapus {idx}", callback_data=f"del:{owner}:{f['seq']}:{page}"),
+        ])
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("« Sebelumnya", callback_data=f"list:{owner}:{page - 1}"))
+    if page + 1 < page_count(state):
+        nav.append(InlineKeyboardButton("Berikutnya »", callback_data=f"list:{owner}:{page + 1}"))
+    if nav:
+        buttons.append(nav)
+    lines.append("\nTekan tombol untuk mengunduh atau menghapus, atau gunakan /get dan /delete <nomor_file>.")
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+def find_file_by_seq(state, seq):
+    # Records are kept in seq order, so a binary search finds one without a full scan
+    index = bisect.bisect_left(state.files, seq, key=lambda record: record['seq'])
+    if index < len(state.files) and state.files[index]['seq'] == seq:
+        return state.files[index]
+    return None
 
 async def list_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    service = get_drive_service(user_id)
-    if not service:
+    client = await get_drive_client(user_id)
+    if not client:
         await update.message.reply_text("Anda belum login. Gunakan /login untuk login.")
         return
 
-    user_files = files.get(str(user_id), [])
-    if not user_files:
+    state = await storage.user(user_id)
+    await sync_engine.ensure_fresh(state, client)
+    if not state.files:
         await update.message.reply_text("Anda belum mengupload file apapun.")
         return
 
-    msg = "File yang sudah Anda upload:\n"
-    for idx, f in enumerate(user_files, start=1):
-        mime = f.get('mime_type', 'unknown')
-        msg += f"{idx}. {f['name']} ({mime})\n"
-    msg += "\nGunakan perintah /delete <nomor_file> untuk menghapus file."
-    await update.message.reply_text(msg)
+    text, markup = list_pages.get(state, 0)
+    await update.message.reply_text(text, reply_markup=markup)
 
-async def get_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def delete_confirmation(owner, record, page):
+    text = f"Hapus '{record.get('name', 'file')}' dari Google Drive? File akan dihapus permanen."
+    markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Ya, hapus", callback_data=f"delok:{owner}:{record['seq']}:{page}"),
+        InlineKeyboardButton("Batal", callback_data=f"list:{owner}:{page}"),
+    ]])
+    return text, markup
+
+async def list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
     user_id = update.effective_user.id
-    service = get_drive_service(user_id)
-    if not service:
-        await update.message.reply_text("Anda belum login. Gunakan /login untuk login.")
+    action, owner, *args = query.data.split(':')
+    if owner != str(user_id):
+        await query.answer("Tombol ini hanya bisa dipakai oleh pemilik daftar.", show_alert=True)
         return
 
-    if len(context.args) != 1:
-        await update.message.reply_text("Gunakan perintah: /get <nomor_file>")
+    client = await get_drive_client(user_id)
+    if not client:
+        await query.answer("Anda belum login. Gunakan /login untuk login.", show_alert=True)
         return
 
-    try:
-        file_index = int(context.args[0]) - 1
-    except ValueError:
-        await update.message.reply_text("Nomor file harus berupa angka.")
-        return
+    state = await storage.user(user_id)
+    await sync_engine.ensure_fresh(state, client)
+    page = int(args[-1])
+    notice = None
+    if action in ('get', 'del', 'delok'):
+        record = find_file_by_seq(state, int(args[0]))
+        if record is None:
+            notice = "File sudah tidak ada."
+        elif action == 'get':
+            await query.answer()
+            await send_user_file(context.bot, query.message, user_id, client, record)
+            return
+        elif action == 'del':
+            # Deleting is permanent, so the first tap only asks for confirmation
+            await query.answer()
+            text, markup = delete_confirmation(owner, record, page)
+            await query.edit_message_text(text, reply_markup=markup)
+            return
+        else:
+            try:
+                await delete_user_file(client, state, record)
+                notice = f"File '{record.get('name', 'file')}' berhasil dihapus."
+            except Exception as e:
+                logger.error(f"Error deleting file {record['id']}: {e}")
+                await query.answer("Gagal menghapus file.", show_alert=True)
+                return
 
-    user_files = files.get(str(user_id), [])
-    if file_index < 0 or file_index >= len(user_files):
-        await update.message.reply_text("Nomor file tidak valid.")
+    await query.answer(notice)
+    if not state.files:
+        await query.edit_message_text("Anda belum mengupload file apapun.")
         return
+    text, markup = list_pages.get(state, min(page, page_count(state) - 1))
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        # Tapping the page that is already shown leaves the message unchanged
+        if 'not modified' not in str(e):
+            raise
 
-    file_metadata = user_files[file_index]
+async def resend_by_file_id(bot, chat_id, user_id, record):
+    # Sends a file Telegram already has by its file_id. Returns False, and forgets the
+    # id, if there is none, it was sent under another name or Telegram no longer accepts it.
+    if not record.get('telegram_file_id'):
+        return False
+    if telegram_copy_usable(record):
+        try:
+            if record.get('telegram_type') == 'photo':
+                await bot.send_photo(chat_id, record['telegram_file_id'])
+            else:
+                await bot.send_document(chat_id, record['telegram_file_id'])
+            return True
+        except TelegramError as e:
+            logger.warning(f"Cached file_id for {record['id']} rejected, streaming from Drive instead: {e}")
+    state = await storage.user(user_id)
+    if state.ids.get(record['id']) is record:
+        forget_telegram_copy(record)
+        storage.update_file(state, record)
+    return False
+
+async def stream_file_to_chat(bot, chat_id, user_id, client, file_metadata, job):
+    # Drive is read into a spool so a slow Telegram upload does not hold the Drive connection open
+    spool = Spool(user_id, DOWNLOAD_BUFFER_SIZE)
+    producer = asyncio.create_task(fill_spool(client.iter_media(file_metadata['id'], DOWNLOAD_CHUNK_SIZE), spool))
+    try:
+        chunks = counted_chunks(spool.chunks(DOWNLOAD_CHUNK_SIZE), job)
+        sent = await send_document_stream(bot, chat_id, chunks, file_metadata.get('name', 'file'))
+    finally:
+        await stop_spool(producer, spool)
+    state = await storage.user(user_id)
+    if file_metadata in state.files and sent.get('document'):
+        file_metadata.update(telegram_file_fields(
+            sent['document']['file_id'], 'document', name=file_metadata.get('name', 'file')
+        ))
+        storage.update_file(state, file_metadata)
+
+async def send_user_file(bot, message, user_id, client, file_metadata):
+    # Sends one of the user's files to the chat of `message`; status replies go to `message`
     file_id = file_metadata['id']
     file_name = file_metadata.get('name', 'file')
+    chat_id = message.chat_id
+
+    if await resend_by_file_id(bot, chat_id, user_id, file_metadata):
+        return
 
     try:
-        request = service.files().get_media(fileId=file_id)
-        fh = open(f'temp_{file_id}', 'wb')
-        downloader = googleapiclient.http.MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        fh.close()
-
-        with open(f'temp_{file_id}', 'rb') as f:
-            await update.message.reply_document(f, filename=file_name)
-
-        os.remove(f'temp_{file_id}')
+        metadata = await client.get(file_id, fields='size')
     except Exception as e:
         logger.error(f"Error downloading file {file_id}: {e}")
-        await update.message.reply_text("Gagal mengunduh file.")
+        await message.reply_text("Gagal mengunduh file.")
+        return
+    size = int(metadata.get('size', 0))
+    if size > TELEGRAM_UPLOAD_LIMIT:
+        await message.reply_text(
+            f"File terlalu besar untuk dikirim lewat Telegram (maksimal {TELEGRAM_UPLOAD_LIMIT // MB} MB)."
+        )
+        return
+
+    async def run(job):
+        await stream_file_to_chat(bot, chat_id, user_id, client, file_metadata, job)
+        return f"File '{file_name}' berhasil dikirim."
+
+    # The user is waiting for this one file, so it takes the fast lane whatever its size
+    job = TransferJob(
+        user_id, 'download', file_name, size, run, "Gagal mengunduh file.", interactive=True,
+        memory=DOWNLOAD_BUFFER_SIZE + DOWNLOAD_CHUNK_SIZE, disk=spool_reservation(size, DOWNLOAD_BUFFER_SIZE),
+    )
+    await scheduler.submit(message, job)
+
+def parse_file_numbers(args, count):
+    # "3-10,14" (commas or spaces) -> zero-based indexes in the order given, no repeats.
+    # Raises ValueError on anything malformed or out of range.
+    indexes = []
+    for token in ','.join(args).replace(' ', ',').split(','):
+        if not token:
+            continue
+        first, dash, last = token.partition('-')
+        first = int(first)
+        last = int(last) if dash else first  # int('') rejects "3-"
+        if not 1 <= first <= last <= count:
+            raise ValueError(token)
+        indexes.extend(range(first - 1, last))
+    if not indexes:
+        raise ValueError("no file numbers")
+    return list(dict.fromkeys(indexes))
+
+MEDIA_GROUP_SIZE = 10  # Telegram's limit per sendMediaGroup
+
+async def send_media_groups(bot, chat_id, user_id, records):
+    # Sends records Telegram already has in albums of up to 10, documents and photos
+    # apart since an album cannot mix them. Returns the records that could not be sent.
+    failed = []
+    for telegram_type, media_class in (('document', InputMediaDocument), ('photo', InputMediaPhoto)):
+        group = [r for r in records if r.get('telegram_type', 'document') == telegram_type]
+        for start in range(0, len(group), MEDIA_GROUP_SIZE):
+            chunk = group[start:start + MEDIA_GROUP_SIZE]
+            if len(chunk) == 1:
+                if not await resend_by_file_id(bot, chat_id, user_id, chunk[0]):
+                    failed.append(chunk[0])
+                continue
+            try:
+                await bot.send_media_group(chat_id, [media_class(r['telegram_file_id']) for r in chunk])
+            except TelegramError as e:
+                logger.warning(f"Media group of {len(chunk)} cached files rejected, streaming them instead: {e}")
+                failed.extend(chunk)
+    return failed
+
+async def send_user_files(bot, message, user_id, client, records):
+    # Cached files go out as media groups right away; the rest stream from Drive one after
+    # another in a single transfer job whose final message is the summary for all of them.
+    chat_id = message.chat_id
+    cached = [r for r in records if telegram_copy_usable(r)]
+    failed = {r['id'] for r in await send_media_groups(bot, chat_id, user_id, cached)}
+    sent = len(cached) - len(failed)
+    to_stream = [r for r in records if not telegram_copy_usable(r) or r['id'] in failed]
+    errors = []
+    if not to_stream:
+        await message.reply_text(f"{sent} file berhasil dikirim.")
+        return
+
+    def summary(streamed):
+        lines = [f"{sent + streamed} dari {len(records)} file berhasil dikirim."]
+        if errors:
+            lines.append("Gagal:")
+            lines += [f"- {error}" for error in errors]
+        return "\n".join(lines)
+
+    try:
+        sizes = await client.batch([('GET', f"files/{r['id']}", {'fields': 'size'}) for r in to_stream])
+    except Exception as e:
+        logger.error(f"Error reading {len(to_stream)} files: {e}")
+        errors += [f"{r.get('name', 'file')}: gagal dibaca" for r in to_stream]
+        await message.reply_text(summary(0))
+        return
+    streamable = []
+    for record, (status, body) in zip(to_stream, sizes):
+        name = record.get('name', 'file')
+        if status >= 400:
+            errors.append(f"{name}: tidak ditemukan di Google Drive" if status == 404 else f"{name}: gagal dibaca")
+        elif int(body.get('size', 0)) > TELEGRAM_UPLOAD_LIMIT:
+            errors.append(f"{name}: lebih dari {TELEGRAM_UPLOAD_LIMIT // MB} MB")
+        else:
+            streamable.append((record, int(body.get('size', 0))))
+
+    if not streamable:
+        await message.reply_text(summary(0))
+        return
+
+    async def run(job):
+        streamed = 0
+        for record, _ in streamable:
+            try:
+                await stream_file_to_chat(bot, chat_id, user_id, client, record, job)
+                streamed += 1
+            except Exception as e:
+                logger.error(f"Error sending file {record['id']}: {e}")
+                errors.append(f"{record.get('name', 'file')}: gagal dikirim")
+        return summary(streamed)
+
+    total = sum(size for _, size in streamable)
+    largest = max(size for _, size in streamable)
+    job = TransferJob(
+        user_id, 'download', f"{len(streamable)} file", total, run, summary(0),
+        memory=DOWNLOAD_BUFFER_SIZE + DOWNLOAD_CHUNK_SIZE, disk=spool_reservation(largest, DOWNLOAD_BUFFER_SIZE),
+    )
+    await scheduler.submit(message, job)
+
+async def get_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    client = await get_drive_client(user_id)
+    if not client:
+        await update.message.reply_text("Anda belum login. Gunakan /login untuk login.")
+        return
+
+    if not context.args:
+        await update.message.reply_text("Gunakan perintah: /get <nomor_file>, misalnya /get 3 atau /get 3-10,14")
+        return
+
+    state = await storage.user(user_id)
+    await sync_engine.ensure_fresh(state, client)
+    user_files = state.files
+    try:
+        file_indexes = parse_file_numbers(context.args, len(user_files))
+    except ValueError:
+        await update.message.reply_text("Nomor file tidak valid. Contoh: /get 3 atau /get 3-10,14")
+        return
+
+    if len(file_indexes) == 1:
+        await send_user_file(context.bot, update.message, user_id, client, user_files[file_indexes[0]])
+    else:
+        await send_user_files(context.bot, update.message, user_id, client, [user_files[i] for i in file_indexes])
 
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    service = get_drive_service(user_id)
-    if not service:
+    client = await get_drive_client(user_id)
+    if not client:
         await update.message.reply_text("Anda belum login. Gunakan /login untuk login.")
         return
 
@@ -234,105 +1562,215 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     file_id = file.file_id
     mime_type = file.mime_type if hasattr(file, 'mime_type') else 'application/octet-stream'
+    telegram_type = 'document' if update.message.document else 'photo'
+    unique_id = file.file_unique_id
+    original_file_name = file.file_name if hasattr(file, 'file_name') else f"photo_{file_id}.jpg"
 
     caption = update.message.caption
+    if update.message.media_group_id:
+        albums.add(update, context, client, {
+            'file_id': file_id,
+            'original_name': original_file_name,
+            'mime_type': mime_type,
+            'size': file.file_size,
+            'telegram_type': telegram_type,
+            'unique_id': unique_id,
+            'caption': caption.strip() if caption else None,
+        })
+        return ASK_FILENAME if pending_uploads(context) else ConversationHandler.END
+
+    # Album items are checked together in upload_album
+    refusal = await preflight_upload(user_id, client, file.file_size)
+    if refusal is not None:
+        await update.message.reply_text(refusal)
+        return
+
     if caption and caption.strip():
         file_name = caption.strip()
-        file_obj = await context.bot.get_file(file_id)
-        file_path = f'temp_{file_id}'
-        await file_obj.download_to_drive(file_path)
+        await upload_telegram_file(
+            update, context, client, file_id, file_name, mime_type, file.file_size, telegram_type, unique_id,
+            original_file_name,
+        )
+    else:
+        file_name = auto_file_name(await storage.user(user_id), original_file_name, update.message.date.astimezone())
+        if file_name is not None:
+            await upload_telegram_file(
+                update, context, client, file_id, file_name, mime_type, file.file_size, telegram_type, unique_id,
+                original_file_name,
+            )
+            return ASK_FILENAME if pending_uploads(context) else ConversationHandler.END
 
-        try:
-            media = googleapiclient.http.MediaFileUpload(file_path, mimetype=mime_type, resumable=True)
-            file_metadata = {'name': file_name}
-            uploaded_file = service.files().create(body=file_metadata, media_body=media, fields='id, name').execute()
+        queue = pending_uploads(context)
+        queue.append(await start_speculative_upload(
+            update, context, client, file_id, original_file_name, mime_type, file.file_size, telegram_type,
+            unique_id,
+        ))
+        if len(queue) == 1:
+            await ask_filename(update, queue[0])
+        else:
+            await update.message.reply_text(
+                f"File diterima: {original_file_name}\n"
+                f"Upload sudah dimulai. File ini ada di urutan ke-{len(queue)} untuk diberi nama."
+            )
+        return ASK_FILENAME
 
-            # Save metadata in memory only
-            user_files = files.get(str(user_id), [])
-            user_files.append({'id': uploaded_file['id'], 'name': file_name, 'mime_type': mime_type})
-            files[str(user_id)] = user_files
+    # Files still waiting for a name keep the conversation going
+    return ASK_FILENAME if pending_uploads(context) else ConversationHandler.END
 
-            await update.message.reply_text(f"File '{file_name}' berhasil diupload ke Google Drive.")
-        except Exception as e:
-            logger.error(f"Error uploading file: {e}")
-            await update.message.reply_text("Gagal mengupload file.")
-        finally:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-    else:
-        original_file_name = file.file_name if hasattr(file, 'file_name') else f"photo_{file_id}.jpg"
-        context.user_data['upload_file_info'] = {
-            'file_id': file_id,
-            'original_file_name': original_file_name,
-            'mime_type': mime_type
-        }
+async def ask_filename(update, pending):
+    await update.message.reply_text(
+        f"File diterima: {pending.original_name}\n"
+        "Silakan kirim nama file yang ingin Anda gunakan untuk menyimpan file ini (termasuk ekstensi). "
+        "Upload sudah dimulai sambil menunggu, /cancel untuk membatalkan.\n"
+        "Atur /naming agar file berikutnya diberi nama otomatis."
+    )
 
-        await update.message.reply_text(
-            f"File diterima: {original_file_name}\n"
-            "Silakan kirim nama file yang ingin Anda gunakan untuk menyimpan file ini (termasuk ekstensi)."
-        )
+async def next_filename(update, context):
+    # Prompts for the next queued file, if any, and returns the conversation state
+    queue = pending_uploads(context)
+    if not queue:
+        return ConversationHandler.END
+    await ask_filename(update, queue[0])
+    return ASK_FILENAME
 
 ASK_FILENAME = 1
 
 async def receive_filename(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if 'upload_file_info' not in context.user_data:
+    queue = pending_uploads(context)
+    if not queue:
         await update.message.reply_text("Tidak ada file yang sedang diupload. Silakan kirim file terlebih dahulu.")
         return ConversationHandler.END
 
-    file_info = context.user_data['upload_file_info']
-    file_id = file_info['file_id']
-    mime_type = file_info['mime_type']
-
     file_name = update.message.text.strip()
     if not file_name:
         await update.message.reply_text("Nama file tidak boleh kosong. Silakan kirim nama file yang valid.")
         return ASK_FILENAME
 
-    service = get_drive_service(user_id)
-    if not service:
+    pending = queue.popleft()
+    client = await get_drive_client(user_id)
+    if not client:
+        for entry in [pending, *queue]:
+            await entry.abandon()
+        queue.clear()
         await update.message.reply_text("Anda belum login. Gunakan /login untuk login.")
         return ConversationHandler.END
 
-    file_obj = await context.bot.get_file(file_id)
-    file_path = f'temp_{file_id}'
-    await file_obj.download_to_drive(file_path)
+    if pending.duplicate_of is not None:
+        await pending.abandon()
+        try:
+            text = await reuse_duplicate(
+                client, await storage.user(user_id), pending.duplicate_of, file_name, pending.record_fields()
+            )
+        except Exception as e:
+            logger.error(f"Error copying {pending.duplicate_of['id']} as {file_name}: {e}")
+            text = "Gagal menyalin file."
+        if text is not None:
+            await update.message.reply_text(text)
+            return await next_filename(update, context)
+        pending.failed = True
+
+    if pending.failed:
+        # The speculative upload did not make it; upload again under the chosen name
+        await pending.abandon()
+        await upload_telegram_file(
+            update, context, client, pending.file_id, file_name, pending.mime_type, pending.size,
+            pending.telegram_type, pending.unique_id, pending.original_name,
+        )
+        return await next_filename(update, context)
 
     try:
-        media = googleapiclient.http.MediaFileUpload(file_path, mimetype=mime_type, resumable=True)
-        file_metadata = {'name': file_name}
-        uploaded_file = service.files().create(body=file_metadata, media_body=media, fields='id, name').execute()
+        text = await pending.set_name(file_name)
+    except Exception as e:
+        logger.error(f"Error renaming uploaded file to {file_name}: {e}")
+        text = "Gagal mengganti nama file."
+    if text is None:
+        text = f"Nama file disimpan. File akan disimpan sebagai '{file_name}' setelah upload selesai."
+    await update.message.reply_text(text)
+    return await next_filename(update, context)
 
-        user_files = files.get(str(user_id), [])
-        user_files.append({'id': uploaded_file['id'], 'name': file_name, 'mime_type': mime_type})
-        files[str(user_id)] = user_files
+async def cancel_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    queue = pending_uploads(context)
+    if not queue:
+        await update.message.reply_text("Tidak ada upload yang sedang menunggu nama file.")
+        return ConversationHandler.END
 
-        await update.message.reply_text(f"File '{file_name}' berhasil diupload ke Google Drive.")
-    except Exception as e:
-        logger.error(f"Error uploading file: {e}")
-        await update.message.reply_text("Gagal mengupload file.")
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    if context.args and context.args[0].lower() == 'semua':
+        cancelled = list(queue)
+        queue.clear()
+    else:
+        cancelled = [queue.popleft()]
+    for pending in cancelled:
+        await pending.abandon()
+    names = ", ".join(f"'{pending.original_name}'" for pending in cancelled)
+    await update.message.reply_text(f"Upload {names} dibatalkan.")
+    return await next_filename(update, context)
 
-    context.user_data.pop('upload_file_info', None)
-    return ConversationHandler.END
+async def naming(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = await storage.user(update.effective_user.id)
+    if not context.args:
+        rule = state.settings.get('naming', 'ask')
+        lines = [f"Aturan nama saat ini: {rule} ({NAMING_RULES[rule]})", "", "Pilihan:"]
+        lines += [f"/naming {key} - {description}" for key, description in NAMING_RULES.items()]
+        lines.append("Contoh: /naming timestamp foto_%Y%m%d_%H%M%S{ext} atau /naming counter liburan")
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    rule = context.args[0].lower()
+    if rule not in NAMING_RULES:
+        await update.message.reply_text("Aturan tidak dikenal. Gunakan /naming untuk melihat pilihan.")
+        return
+
+    settings = {
+        key: value for key, value in state.settings.items() if key not in ('template', 'prefix', 'counter')
+    }
+    settings['naming'] = rule
+    argument = " ".join(context.args[1:]).strip()
+    if rule == 'timestamp':
+        template = argument or DEFAULT_TIMESTAMP_TEMPLATE
+        try:
+            example = render_timestamp_name(template, 'foto.jpg', datetime.datetime.now().astimezone())
+        except ValueError:
+            await update.message.reply_text(
+                "Template tidak valid. Gunakan kode waktu seperti %Y%m%d, {name} dan {ext}; "
+                "kurung kurawal lain tidak diizinkan."
+            )
+            return
+        settings['template'] = template
+        description = f"template '{template}', contoh: {example}"
+    elif rule == 'counter':
+        if not argument:
+            await update.message.reply_text("Gunakan perintah: /naming counter <awalan>")
+            return
+        settings['prefix'] = argument
+        settings['counter'] = 0
+        description = f"contoh: {argument}_1.jpg, {argument}_2.jpg"
+    else:
+        description = NAMING_RULES[rule]
+    storage.set_settings(state, settings)
+    await update.message.reply_text(f"Aturan nama diubah ke {rule} ({description}).")
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     commands_text = (
         "Menu perintah yang tersedia:\n"
         "/start - Mulai bot\n"
         "/login - Login ke Google Drive\n"
-        "/auth <kode> - Kirim kode otentikasi setelah login\n"
+        "/auth <kode> - Kirim kode otentikasi jika login tidak selesai otomatis\n"
         "/logout - Logout dari Google Drive\n"
         "/list - Daftar file yang diupload\n"
-        "/get <nomor_file> - Unduh file berdasarkan nomor\n"
-        "/delete <nomor_file> - Hapus file berdasarkan nomor\n"
+        "/get <nomor_file> - Unduh file berdasarkan nomor, bisa rentang seperti 3-10,14\n"
+        "/delete <nomor_file> - Hapus file berdasarkan nomor, bisa rentang seperti 3-10,14\n"
+        "/cancel [semua] - Batalkan upload yang sedang menunggu nama file\n"
+        "/naming - Atur nama otomatis untuk file tanpa caption\n"
         "/menu - Tampilkan menu perintah ini\n\n"
         "Instruksi Upload File:\n"
         "- Kirim file yang ingin diupload ke bot.\n"
         "- Anda dapat memberikan nama file dengan mengirim caption saat mengirim file.\n"
-        "- Jika tidak memberikan caption, bot akan meminta Anda mengirim nama file (termasuk ekstensi).\n"
+        "- Jika tidak memberikan caption, bot akan meminta Anda mengirim nama file (termasuk ekstensi). "
+        "File sudah mulai diupload selama Anda mengetik namanya.\n"
+        "- Album (beberapa foto/file sekaligus) diupload bersama dalam satu proses dengan satu pesan ringkasan.\n"
+        "- Beberapa file sekaligus akan ditanyakan namanya satu per satu, atau atur /naming agar "
+        "diberi nama otomatis.\n"
         "- Contoh nama file yang valid:\n"
         "  - dokumen.pdf\n"
         "  - foto_liburan.jpg\n"
@@ -343,50 +1781,230 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(commands_text)
 
+def format_upload_latency(strategy):
+    entry = upload_latency[strategy]
+    average = entry['seconds'] / entry['uploads'] * 1000 if entry['uploads'] else 0.0
+    return f"{strategy} {entry['uploads']} file, rata-rata {average:.0f} ms"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    pool = io_executor.stats()
+    store = storage.stats()
+    tok = tokens.stats()
+    up = upload_metrics
+    up_rate = up['bytes'] / up['seconds'] / 1024 / 1024 if up['seconds'] else 0.0
+    sched = scheduler.stats()
+    gov = governor.stats()
+    dup = dedup.stats()
+    sync = sync_engine.stats()
+    pages = list_pages
+    bandwidth_budget = f"{gov['bandwidth_budget'] / MB:.1f} MB/s" if gov['bandwidth_budget'] else "tanpa batas"
+    await update.message.reply_text(
+        "Statistik bot:\n"
+        f"I/O pool: {pool['active']}/{pool['workers']} aktif, {pool['waiting']} menunggu, "
+        f"{pool['users']} pengguna\n"
+        f"Storage: {store['users']} pengguna di memori, {store['pending']} perubahan belum ditulis\n"
+        f"Token: {tok['users']} aktif, {tok['refreshes']} refresh ({tok['proactive']} proaktif, "
+        f"{tok['coalesced']} digabung), {tok['failures']} gagal, "
+        f"latensi rata-rata {tok['avg_latency'] * 1000:.0f} ms, maks {tok['max_latency'] * 1000:.0f} ms\n"
+        f"Upload: {up['uploads']} file, {up['chunks']} chunk, {up_rate:.2f} MiB/s per chunk, "
+        f"{up['retries']} retry\n"
+        f"Strategi upload: {format_upload_latency('multipart')}; {format_upload_latency('resumable')}\n"
+        f"Dedup: {dup['lookups']} pencarian, {dup['hits']} duplikat\n"
+        f"Cache halaman /list: {len(pages)} halaman, hit {pages.hits}, miss {pages.misses}\n"
+        f"Sinkronisasi Drive: {sync['syncs']} kali ({sync['bootstraps']} penuh), {sync['changes']} perubahan, "
+        f"{sync['notifications']} notifikasi push\n"
+        f"Transfer: {sched['active']} berjalan, antrean cepat {sched['fast']}, antrean besar {sched['bulk']}, "
+        f"{sched['completed']} selesai, {sched['failed']} gagal, rata-rata {sched['rate'] / MB:.2f} MB/s per job\n"
+        f"Sumber daya: RAM {format_size(gov['memory'])}/{format_size(gov['memory_budget'])}, "
+        f"disk {format_size(gov['disk'])}/{format_size(gov['disk_budget'])} "
+        f"(dipesan {format_size(gov['disk_reserved'])}), "
+        f"bandwidth {gov['bandwidth'] / MB:.1f} MB/s dari {bandwidth_budget}, {gov['shed']} transfer ditolak"
+    )
+
+async def delete_user_file(client, state, record):
+    try:
+        await client.delete(record['id'])
+    except DriveError as e:
+        # Already gone from Drive, like in the multi-file /delete it only needs to leave the index
+        if e.status != 404:
+            raise
+    storage.remove_file(state, record)
+    quotas.mark_stale(state.user_id)
+
 async def delete_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    service = get_drive_service(user_id)
-    if not service:
+    client = await get_drive_client(user_id)
+    if not client:
         await update.message.reply_text("Anda belum login. Gunakan /login untuk login.")
         return
 
-    if len(context.args) != 1:
-        await update.message.reply_text("Gunakan perintah: /delete <nomor_file>")
+    if not context.args:
+        await update.message.reply_text(
+            "Gunakan perintah: /delete <nomor_file>, misalnya /delete 3 atau /delete 3-10,14"
+        )
         return
 
+    state = await storage.user(user_id)
+    await sync_engine.ensure_fresh(state, client)
     try:
-        file_index = int(context.args[0]) - 1
+        file_indexes = parse_file_numbers(context.args, len(state.files))
     except ValueError:
-        await update.message.reply_text("Nomor file harus berupa angka.")
+        await update.message.reply_text("Nomor file tidak valid. Contoh: /delete 3 atau /delete 3-10,14")
         return
 
-    user_files = files.get(str(user_id), [])
-    if file_index < 0 or file_index >= len(user_files):
-        await update.message.reply_text("Nomor file tidak valid.")
+    records = [state.files[i] for i in file_indexes]
+    if len(records) == 1:
+        file_metadata = records[0]
+        file_id = file_metadata['id']
+        file_name = file_metadata.get('name', 'file')
+        try:
+            await delete_user_file(client, state, file_metadata)
+            await update.message.reply_text(f"File '{file_name}' berhasil dihapus.")
+        except Exception as e:
+            logger.error(f"Error deleting file {file_id}: {e}")
+            await update.message.reply_text("Gagal menghapus file.")
         return
 
-    file_metadata = user_files[file_index]
-    file_id = file_metadata['id']
-    file_name = file_metadata.get('name', 'file')
-
     try:
-        service.files().delete(fileId=file_id).execute()
-        user_files.pop(file_index)
-        files[str(user_id)] = user_files
-        await update.message.reply_text(f"File '{file_name}' berhasil dihapus.")
+        results = await client.batch([('DELETE', f"files/{r['id']}", None) for r in records])
     except Exception as e:
-        logger.error(f"Error deleting file {file_id}: {e}")
+        logger.error(f"Error deleting {len(records)} files: {e}")
         await update.message.reply_text("Gagal menghapus file.")
+        return
+    # A file already gone from Drive only needs to leave the index
+    deleted = [r for r, (status, _) in zip(records, results) if status < 400 or status == 404]
+    failed = [r for r, (status, _) in zip(records, results) if 400 <= status != 404]
+    storage.remove_files(state, deleted)
+    quotas.mark_stale(user_id)
+    lines = [f"{len(deleted)} dari {len(records)} file berhasil dihapus."]
+    if failed:
+        lines.append("Gagal dihapus: " + ", ".join(f"'{r.get('name', 'file')}'" for r in failed))
+    await update.message.reply_text("\n".join(lines))
+
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
+# PTB takes its concurrency slot before calling process_update, i.e. before the user's lock,
+# so updates waiting behind one busy user would hold everybody else's slots. PTB gets more
+# slots than can ever be used and CONCURRENT_UPDATES is applied inside the lock instead.
+PTB_CONCURRENT_UPDATES = 2 ** 30
+
+update_slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+
+class UserLocks:
+    # One asyncio.Lock per user, dropped again once nobody holds or waits for it
+    def __init__(self):
+        self._locks = {}  # user_id -> [lock, holders and waiters]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id):
+        entry = self._locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def __len__(self):
+        return len(self._locks)
+
+user_locks = UserLocks()
+
+class PerUserOrderedApplication(Application):
+    # With concurrent updates PTB handles every update in its own task. Updates from the
+    # same user queue on that user's lock in arrival order, so different users run in
+    # parallel while one user's commands and conversation replies still apply in order
+    # and never race on their file list. Only an update holding its user's lock competes
+    # for one of the CONCURRENT_UPDATES slots.
+    async def process_update(self, update):
+        user = update.effective_user if isinstance(update, Update) else None
+        try:
+            if user is None:
+                async with update_slots:
+                    return await super().process_update(update)
+            with storage.pinned(user.id):
+                async with user_locks.hold(user.id):
+                    async with update_slots:
+                        return await super().process_update(update)
+        finally:
+            if BOT_MODE == 'webhook':
+                webhook_backlog.done()
+
+async def handle_error(update, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(context.error, TokenUnavailable):
+        logger.warning(f"{context.error}: {context.error.__cause__}")
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text(
+                "Google Drive sedang tidak bisa dihubungi. Silakan coba lagi sebentar lagi."
+            )
+        return
+    logger.error("Error while handling an update", exc_info=context.error)
+
+async def post_init(application):
+    storage.start()
+    sweep_spool_dir()
+    global spool_sweeper
+    spool_sweeper = asyncio.create_task(sweep_spool_periodically())
+    await start_web_server(application)
+
+async def post_shutdown(application):
+    if spool_sweeper is not None:
+        spool_sweeper.cancel()
+    await stop_web_server()
+    await storage.stop()
+    await close_http_session()
+
+async def run_webhook(application):
+    # Application.run_webhook() would start its own server; drive the lifecycle by hand
+    # so updates arrive on the aiohttp app that also serves the OAuth callback.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Receiving updates via webhook at {WEBHOOK_URL}")
+        await stop.wait()
+    finally:
+        await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
 
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .base_file_url(TELEGRAM_API_FILE_URL)
+        .local_mode(TELEGRAM_LOCAL_MODE)
+        .application_class(PerUserOrderedApplication)
+        .concurrent_updates(PTB_CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == 'webhook':
+        builder = builder.updater(None)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[MessageHandler(filters.Document.ALL | filters.PHOTO, handle_file)],
         states={
             ASK_FILENAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_filename)],
         },
-        fallbacks=[],
+        fallbacks=[CommandHandler("cancel", cancel_upload)],
+        allow_reentry=True,
     )
 
     application.add_handler(CommandHandler("start", start))
@@ -396,10 +2014,17 @@ def main():
     application.add_handler(CommandHandler("list", list_files))
     application.add_handler(CommandHandler("get", get_file))
     application.add_handler(CommandHandler("delete", delete_file))
+    application.add_handler(CommandHandler("naming", naming))
     application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CallbackQueryHandler(list_callback, pattern=r'^(list|get|del|delok):'))
     application.add_handler(conv_handler)
+    application.add_error_handler(handle_error)
 
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import urllib.parse
+
+import aiohttp
+from google.auth.exceptions import RefreshError
+
+logger = logging.getLogger(__name__)
+
+class TokenUnavailable(Exception):
+    # The token could not be refreshed for a reason other than the user's grant being
+    # revoked, e.g. Google was unreachable; the user is still logged in and can retry
+    def __init__(self, user_id):
+        super().__init__(f"Could not refresh the token of user {user_id}")
+        self.user_id = user_id
+
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3'
+DRIVE_UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files'
+DRIVE_BATCH_URL = 'https://www.googleapis.com/batch/drive/v3'
+DRIVE_BATCH_LIMIT = 100  # calls per batch request
+DRIVE_CHUNK_GRANULARITY = 256 * 1024  # resumable chunks must be multiples of 256 KiB
+DRIVE_FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '200'))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '64'))
+
+http_session = None  # shared aiohttp session for Drive and Telegram file transfers
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE, limit_per_host=HTTP_POOL_PER_HOST, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120),
+        )
+    return http_session
+
+async def close_http_session():
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+class DriveError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Drive API error {status}: {message}")
+        self.status = status
+
+def file_metadata(file_name, parents=None):
+    metadata = {'name': file_name}
+    if parents:
+        metadata['parents'] = parents
+    return metadata
+
+def parse_batch_response(text):
+    # One embedded HTTP response from a batch reply: status line, headers, blank line, body
+    head, _, payload = text.lstrip().partition('\r\n\r\n')
+    status = int(head.split(None, 2)[1])
+    return status, (json.loads(payload) if payload.strip() else None)
+
+class DriveClient:
+    # Async Drive v3 client on the shared aiohttp session. Every request carries the
+    # user's current bearer token from `tokens` (get/refresh, like the bot's TokenManager);
+    # a rejected token is refreshed once and the request retried.
+    def __init__(self, user_id, tokens):
+        self.user_id = user_id
+        self.tokens = tokens
+
+    async def _request(self, method, url, headers=None, **kwargs):
+        creds = await self.tokens.get(self.user_id)
+        if creds is None:
+            raise DriveError(401, "User is not logged in")
+        token = creds.token
+        resp = await get_http_session().request(
+            method, url, headers={**(headers or {}), 'Authorization': f'Bearer {token}'}, **kwargs
+        )
+        if resp.status == 401 and creds.refresh_token:
+            resp.release()
+            try:
+                creds = await self.tokens.refresh(self.user_id, rejected_token=token)
+            except RefreshError:
+                raise DriveError(401, "User is not logged in")
+            except Exception as e:
+                raise TokenUnavailable(self.user_id) from e
+            resp = await get_http_session().request(
+                method, url, headers={**(headers or {}), 'Authorization': f'Bearer {creds.token}'}, **kwargs
+            )
+        return resp
+
+    @staticmethod
+    async def _raise_for_status(resp):
+        if resp.status < 400:
+            return
+        try:
+            message = (await resp.json(content_type=None))['error']['message']
+        except Exception:
+            message = resp.reason
+        raise DriveError(resp.status, message)
+
+    async def _call(self, method, url, **kwargs):
+        async with await self._request(method, url, **kwargs) as resp:
+            await self._raise_for_status(resp)
+            if resp.status == 204:
+                return None
+            return await resp.json(content_type=None)
+
+    async def list(self, q=None, page_token=None, page_size=100, fields='nextPageToken, files(id, name, mimeType)',
+                   order_by=None):
+        params = {'pageSize': str(page_size), 'fields': fields}
+        if q:
+            params['q'] = q
+        if order_by:
+            params['orderBy'] = order_by
+        if page_token:
+            params['pageToken'] = page_token
+        return await self._call('GET', f'{DRIVE_API_URL}/files', params=params)
+
+    async def batch(self, calls):
+        # Runs (method, path relative to drive/v3, query params) calls in as few HTTP round
+        # trips as the batch endpoint allows. Returns (status, JSON body or None) per call,
+        # in order; individual failures are returned, not raised.
+        results = []
+        for start in range(0, len(calls), DRIVE_BATCH_LIMIT):
+            results += await self._batch(calls[start:start + DRIVE_BATCH_LIMIT])
+        return results
+
+    async def _batch(self, calls):
+        with aiohttp.MultipartWriter('mixed') as body:
+            for index, (method, path, params) in enumerate(calls):
+                query = f"?{urllib.parse.urlencode(params)}" if params else ''
+                body.append(
+                    f"{method} /drive/v3/{path}{query}\r\n\r\n",
+                    {'Content-Type': 'application/http', 'Content-ID': f'<item{index}>'},
+                )
+        results = [(500, None)] * len(calls)
+        async with await self._request('POST', DRIVE_BATCH_URL, data=body) as resp:
+            await self._raise_for_status(resp)
+            reader = aiohttp.MultipartReader.from_response(resp)
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                # Responses carry Content-ID "<response-itemN>" and may arrive in any order
+                index = int(part.headers.get('Content-ID', '').strip('<>').rsplit('item', 1)[1])
+                results[index] = parse_batch_response(await part.text())
+        return results
+
+    async def start_page_token(self):
+        return (await self._call(
+            'GET', f'{DRIVE_API_URL}/changes/startPageToken', params={'fields': 'startPageToken'}
+        ))['startPageToken']
+
+    async def changes(self, page_token, fields, page_size=1000):
+        return await self._call('GET', f'{DRIVE_API_URL}/changes', params={
+            'pageToken': page_token, 'pageSize': str(page_size), 'fields': fields, 'spaces': 'drive',
+        })
+
+    async def watch_changes(self, page_token, channel_id, address, token, expiration_ms):
+        return await self._call(
+            'POST', f'{DRIVE_API_URL}/changes/watch', params={'pageToken': page_token},
+            json={'id': channel_id, 'type': 'web_hook', 'address': address, 'token': token,
+                  'expiration': str(expiration_ms)},
+        )
+
+    async def stop_channel(self, channel_id, resource_id):
+        await self._call('POST', f'{DRIVE_API_URL}/channels/stop', json={'id': channel_id, 'resourceId': resource_id})
+
+    async def about(self, fields):
+        return await self._call('GET', f'{DRIVE_API_URL}/about', params={'fields': fields})
+
+    async def get(self, file_id, fields='id, name, mimeType, size'):
+        return await self._call('GET', f'{DRIVE_API_URL}/files/{file_id}', params={'fields': fields})
+
+    async def update(self, file_id, metadata, fields='id, name'):
+        return await self._call(
+            'PATCH', f'{DRIVE_API_URL}/files/{file_id}', params={'fields': fields}, json=metadata
+        )
+
+    async def copy(self, file_id, file_name, fields='id, name', parents=None):
+        return await self._call(
+            'POST', f'{DRIVE_API_URL}/files/{file_id}/copy', params={'fields': fields},
+            json=file_metadata(file_name, parents),
+        )
+
+    async def create_folder(self, name, fields='id, name'):
+        return await self._call(
+            'POST', f'{DRIVE_API_URL}/files', params={'fields': fields},
+            json={'name': name, 'mimeType': DRIVE_FOLDER_MIME_TYPE},
+        )
+
+    async def delete(self, file_id):
+        await self._call('DELETE', f'{DRIVE_API_URL}/files/{file_id}')
+
+    async def iter_media(self, file_id, chunk_size):
+        async with await self._request('GET', f'{DRIVE_API_URL}/files/{file_id}', params={'alt': 'media'}) as resp:
+            await self._raise_for_status(resp)
+            async for data in resp.content.iter_chunked(chunk_size):
+                yield data
+
+    async def create_resumable(self, file_name, mime_type, size=None, fields='id, name', parents=None):
+        headers = {'X-Upload-Content-Type': mime_type}
+        if size is not None:
+            headers['X-Upload-Content-Length'] = str(size)
+        async with await self._request(
+            'POST', DRIVE_UPLOAD_URL,
+            params={'uploadType': 'resumable', 'fields': fields},
+            json=file_metadata(file_name, parents),
+            headers=headers,
+        ) as resp:
+            await self._raise_for_status(resp)
+            return resp.headers['Location']
+
+    async def upload_multipart(self, file_name, mime_type, data, fields='id, name', parents=None):
+        # Metadata and media in a single multipart/related request, no session to open
+        with aiohttp.MultipartWriter('related') as body:
+            body.append_json(file_metadata(file_name, parents))
+            body.append(data, {'Content-Type': mime_type})
+        return await self._call(
+            'POST', DRIVE_UPLOAD_URL, params={'uploadType': 'multipart', 'fields': fields}, data=body
+        )
+
+    async def upload_chunk(self, upload_url, chunk, offset, total):
+        # Returns (created file, None) once Drive has the last byte, otherwise
+        # (None, number of bytes Drive has persisted so far).
+        total_text = total if total is not None else '*'
+        if chunk:
+            content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total_text}"
+        else:
+            # An empty PUT asks Drive for the session's current state
+            content_range = f"bytes */{total_text}"
+        async with await self._request('PUT', upload_url, data=chunk, headers={'Content-Range': content_range}) as resp:
+            if resp.status == 308:
+                received = resp.headers.get('Range')  # e.g. "bytes=0-524287"
+                return None, int(received.rsplit('-', 1)[1]) + 1 if received else 0
+            await self._raise_for_status(resp)
+            return await resp.json(content_type=None), None
+
+    async def upload_status(self, upload_url, total=None):
+        return await self.upload_chunk(upload_url, b'', None, total)
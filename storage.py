@@ -0,0 +1,332 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'aldrive.db')
+STORAGE_CACHE_SIZE = int(os.getenv('STORAGE_CACHE_SIZE', '1024'))  # users kept in memory
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '1.0'))
+STORAGE_FLUSH_BATCH = int(os.getenv('STORAGE_FLUSH_BATCH', '200'))
+
+class StorageBackend(ABC):
+    # Persistent user state. Methods block and are only called from the storage thread.
+    @abstractmethod
+    def load_user(self, user_id):
+        # Returns (session dict or None, list of file records in upload order, settings dict)
+        ...
+
+    @abstractmethod
+    def apply(self, ops):
+        # Writes a batch of ('set_session' | 'set_settings' | 'delete_user' | 'put_file' | 'delete_file',
+        # user_id, ...) ops
+        ...
+
+    def close(self):
+        pass
+
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+                )
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS settings (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+                )
+                # The (user_id, seq) primary key is the per-user upload-order index
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS files ("
+                    "user_id TEXT NOT NULL, seq INTEGER NOT NULL, data TEXT NOT NULL, "
+                    "PRIMARY KEY (user_id, seq)) WITHOUT ROWID"
+                )
+        return self._conn
+
+    def load_user(self, user_id):
+        conn = self._connect()
+        row = conn.execute("SELECT data FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+        settings_row = conn.execute("SELECT data FROM settings WHERE user_id = ?", (user_id,)).fetchone()
+        rows = conn.execute("SELECT seq, data FROM files WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+        user_files = []
+        for seq, data in rows:
+            record = json.loads(data)
+            record['seq'] = seq
+            user_files.append(record)
+        settings = json.loads(settings_row[0]) if settings_row else {}
+        return (json.loads(row[0]) if row else None), user_files, settings
+
+    def apply(self, ops):
+        conn = self._connect()
+        with conn:
+            for op, user_id, *args in ops:
+                if op == 'set_session':
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sessions (user_id, data) VALUES (?, ?)",
+                        (user_id, json.dumps(args[0])),
+                    )
+                elif op == 'set_settings':
+                    conn.execute(
+                        "INSERT OR REPLACE INTO settings (user_id, data) VALUES (?, ?)",
+                        (user_id, json.dumps(args[0])),
+                    )
+                elif op == 'delete_user':
+                    conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+                    conn.execute("DELETE FROM settings WHERE user_id = ?", (user_id,))
+                    conn.execute("DELETE FROM files WHERE user_id = ?", (user_id,))
+                elif op == 'put_file':
+                    record = {k: v for k, v in args[0].items() if k != 'seq'}
+                    conn.execute(
+                        "INSERT OR REPLACE INTO files (user_id, seq, data) VALUES (?, ?, ?)",
+                        (user_id, args[0]['seq'], json.dumps(record)),
+                    )
+                elif op == 'delete_file':
+                    conn.execute("DELETE FROM files WHERE user_id = ? AND seq = ?", (user_id, args[0]))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+STORAGE_BACKENDS = {
+    'sqlite': lambda: SQLiteBackend(DATABASE_PATH),
+}
+
+# Versions come from one counter for the whole process, so a state reloaded after eviction
+# never repeats a version that pages cached for an earlier copy were rendered at
+state_versions = itertools.count(1)
+
+class UserState:
+    def __init__(self, user_id, session, files, settings):
+        self.user_id = user_id
+        self.session = session    # credentials dict or None
+        self.files = files        # file records in upload order, each with a 'seq' key
+        self.settings = settings  # user preferences such as the naming rule
+        self.version = next(state_versions)  # changes with every change to files, for caches derived from them
+        self.ids = {}             # Drive file id -> record
+        self.by_unique_id = {}    # Telegram file_unique_id -> records with it, oldest first, for dedup
+        self.by_md5 = {}          # MD5 -> records with it, oldest first, for dedup
+        for record in files:
+            self.index(record)
+
+    def _dedup_keys(self, record):
+        return ((self.by_unique_id, record.get('telegram_unique_id')), (self.by_md5, record.get('md5')))
+
+    def index(self, record):
+        self.ids[record['id']] = record
+        for keys, key in self._dedup_keys(record):
+            if key:
+                records = keys.setdefault(key, [])
+                if not any(r is record for r in records):
+                    records.append(record)
+
+    def unindex(self, record):
+        self.ids.pop(record['id'], None)
+        for keys, key in self._dedup_keys(record):
+            records = keys.get(key)
+            if records:
+                records[:] = [r for r in records if r is not record]
+                if not records:
+                    del keys[key]
+
+    def next_seq(self):
+        # List buttons name files by seq, so a seq is never handed out twice, not even
+        # after the newest file was deleted (see Storage._retire_seq)
+        last = self.files[-1]['seq'] if self.files else 0
+        return max(last, self.settings.get('last_seq', 0)) + 1
+
+class Storage:
+    # Lazily loads users into a bounded LRU and writes changes behind in batches.
+    # All mutations happen on the event loop; the backend runs on its own thread.
+    def __init__(self, backend, cache_size):
+        self.backend = backend
+        self.cache_size = cache_size
+        self._users = OrderedDict()  # user_id -> UserState
+        self._loading = {}           # user_id -> future, so concurrent loads share one query
+        self._pending = []           # ops not yet written
+        self._pending_users = {}     # user_id -> pending op count; such users are never evicted
+        self._pinned = {}            # user_id -> holders keeping the state across awaits; never evicted either
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self._stopping = False
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._thread, fn, *args)
+
+    async def user(self, user_id):
+        key = str(user_id)
+        state = self._users.get(key)
+        if state is not None:
+            self._users.move_to_end(key)
+            return state
+        if key not in self._loading:
+            self._loading[key] = asyncio.ensure_future(self._load(key))
+        return await asyncio.shield(self._loading[key])
+
+    async def _load(self, key):
+        try:
+            session, user_files, settings = await self._run(self.backend.load_user, key)
+            state = self._users.get(key)  # may have been created while we waited
+            if state is None:
+                state = self._users[key] = UserState(key, session, user_files, settings)
+                self._evict()
+            return state
+        finally:
+            del self._loading[key]
+
+    def _evict(self):
+        # The most recently used user is the one being served right now, keep it
+        for key in list(self._users)[:-1]:
+            if len(self._users) <= self.cache_size:
+                break
+            if key not in self._pending_users and key not in self._pinned:
+                del self._users[key]
+
+    def pin(self, user_id):
+        # Work that keeps a UserState across awaits (an update being handled, a transfer
+        # job, a sync) pins the user. An evicted state would be reloaded as a second copy
+        # and both would hand out the same seq numbers.
+        key = str(user_id)
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, user_id):
+        key = str(user_id)
+        self._pinned[key] -= 1
+        if not self._pinned[key]:
+            del self._pinned[key]
+
+    @contextlib.contextmanager
+    def pinned(self, user_id):
+        self.pin(user_id)
+        try:
+            yield
+        finally:
+            self.unpin(user_id)
+
+    def _write(self, user_id, *op):
+        self._pending.append((op[0], user_id, *op[1:]))
+        self._pending_users[user_id] = self._pending_users.get(user_id, 0) + 1
+        if len(self._pending) >= STORAGE_FLUSH_BATCH:
+            self._wakeup.set()
+
+    def set_session(self, state, session):
+        state.session = session
+        self._write(state.user_id, 'set_session', session)
+
+    def set_settings(self, state, settings):
+        state.settings = settings
+        self._write(state.user_id, 'set_settings', settings)
+
+    def delete_user(self, state):
+        last_seq = state.next_seq() - 1
+        state.session = None
+        state.files = []
+        state.ids = {}
+        state.by_unique_id = {}
+        state.by_md5 = {}
+        state.settings = {}
+        state.version = next(state_versions)
+        self._write(state.user_id, 'delete_user')
+        if last_seq:
+            # Buttons from before the logout must not match files uploaded after the next login
+            self.set_settings(state, {'last_seq': last_seq})
+
+    def add_file(self, state, record):
+        record['seq'] = state.next_seq()
+        state.files.append(record)
+        state.index(record)
+        state.version = next(state_versions)
+        self._write(state.user_id, 'put_file', record)
+        return record
+
+    def update_file(self, state, record):
+        state.index(record)
+        state.version = next(state_versions)
+        self._write(state.user_id, 'put_file', record)
+
+    def remove_file(self, state, record):
+        # Drive sync may already have removed it while the caller was waiting on Drive
+        if state.ids.get(record['id']) is not record:
+            return record
+        state.files.remove(record)
+        state.unindex(record)
+        state.version = next(state_versions)
+        self._write(state.user_id, 'delete_file', record['seq'])
+        self._retire_seq(state, record['seq'])
+        return record
+
+    def remove_files(self, state, records):
+        # One pass over the user's list however many records go
+        records = [record for record in records if state.ids.get(record['id']) is record]
+        gone = {id(record) for record in records}
+        state.files = [record for record in state.files if id(record) not in gone]
+        for record in records:
+            state.unindex(record)
+            self._write(state.user_id, 'delete_file', record['seq'])
+        state.version = next(state_versions)
+        if records:
+            self._retire_seq(state, max(record['seq'] for record in records))
+
+    def _retire_seq(self, state, seq):
+        # Only the highest seq ever used needs remembering, and only once no remaining
+        # record carries it
+        if seq >= state.next_seq():
+            self.set_settings(state, {**state.settings, 'last_seq': seq})
+
+    async def flush(self):
+        if not self._pending:
+            return
+        ops, self._pending = self._pending, []
+        try:
+            await self._run(self.backend.apply, ops)
+        except Exception as e:
+            logger.error(f"Failed to write {len(ops)} storage ops: {e}")
+            self._pending = ops + self._pending
+            return
+        for _, user_id, *_ in ops:
+            self._pending_users[user_id] -= 1
+            if not self._pending_users[user_id]:
+                del self._pending_users[user_id]
+        self._evict()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), STORAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+        await self._run(self.backend.close)
+
+    def stats(self):
+        return {'users': len(self._users), 'pending': len(self._pending)}
+
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    logger.error(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+    exit(1)
+storage = Storage(STORAGE_BACKENDS[STORAGE_BACKEND](), STORAGE_CACHE_SIZE)
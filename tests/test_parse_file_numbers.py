@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+for module in ('aiohttp', 'telegram', 'google.auth', 'google_auth_oauthlib'):
+    pytest.importorskip(module)
+
+# bot.py reads its configuration at import time
+os.environ.setdefault('TELEGRAM_TOKEN', 'test-token')
+os.environ.setdefault('GOOGLE_CLIENT_ID', 'test-client')
+os.environ.setdefault('GOOGLE_CLIENT_SECRET', 'test-secret')
+
+from bot import parse_file_numbers  # noqa: E402
+
+
+@pytest.mark.parametrize('args, expected', [
+    (['3'], [2]),
+    (['3-5'], [2, 3, 4]),
+    (['3-5,7'], [2, 3, 4, 6]),
+    (['3', '5'], [2, 4]),
+    (['3-5', '4'], [2, 3, 4]),    # repeats are dropped
+    (['5,1-2'], [4, 0, 1]),       # order given is kept
+    (['1,,2'], [0, 1]),
+])
+def test_valid(args, expected):
+    assert parse_file_numbers(args, 10) == expected
+
+
+@pytest.mark.parametrize('args', [
+    [''],
+    ['0'],
+    ['11'],
+    ['1-'],
+    ['-3'],
+    ['5-3'],
+    ['3-11'],
+    ['a'],
+    ['1-2-3'],
+])
+def test_invalid(args):
+    with pytest.raises(ValueError):
+        parse_file_numbers(args, 10)
@@ -0,0 +1,812 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from telegram.error import RetryAfter, TelegramError
+
+from drive import DRIVE_CHUNK_GRANULARITY, DriveError, TokenUnavailable, get_http_session
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# With a self-hosted Bot API server started with --local, file paths point at files on this machine
+TELEGRAM_LOCAL_MODE = os.getenv('TELEGRAM_LOCAL_MODE', '').lower() in ('1', 'true', 'yes')
+
+IO_WORKERS = int(os.getenv('IO_WORKERS', '8'))
+IO_WORKERS_PER_USER = int(os.getenv('IO_WORKERS_PER_USER', '2'))
+
+class BlockingIOExecutor:
+    # Every blocking call (google-auth code exchange and token refresh, local file reads)
+    # goes through here so the event loop only awaits futures.
+    # A user must hold one of their own slots before competing for a worker, so one user's
+    # transfers can occupy at most `per_user` threads and waiters are served in FIFO order.
+    def __init__(self, max_workers, per_user):
+        self.max_workers = max_workers
+        self.per_user = per_user
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drive-io')
+        self._workers = asyncio.Semaphore(max_workers)
+        self._user_slots = {}  # user_id -> [semaphore, number of callers]
+        self.active = 0
+
+    async def run(self, user_id, fn, *args, **kwargs):
+        key = str(user_id)
+        slot = self._user_slots.setdefault(key, [asyncio.Semaphore(self.per_user), 0])
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                async with self._workers:
+                    self.active += 1
+                    try:
+                        loop = asyncio.get_running_loop()
+                        return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+                    finally:
+                        self.active -= 1
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self._user_slots[key]
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'workers': self.max_workers,
+            'users': len(self._user_slots),
+            'waiting': sum(n for _, n in self._user_slots.values()) - self.active,
+        }
+
+io_executor = BlockingIOExecutor(IO_WORKERS, IO_WORKERS_PER_USER)
+
+UPLOAD_CHUNK_SIZE = max(1, int(os.getenv('UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024))) // DRIVE_CHUNK_GRANULARITY) * DRIVE_CHUNK_GRANULARITY
+# The pipe must hold more than one chunk, otherwise the reader could never see a full chunk plus one byte
+UPLOAD_BUFFER_SIZE = max(int(os.getenv('UPLOAD_BUFFER_SIZE', str(2 * UPLOAD_CHUNK_SIZE))), 2 * UPLOAD_CHUNK_SIZE)
+TELEGRAM_READ_SIZE = 64 * 1024
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'aldrive-spool'))
+SPOOL_MAX_FILE_SIZE = int(os.getenv('SPOOL_MAX_FILE_SIZE', str(256 * 1024 * 1024)))  # 0 keeps spools in RAM only
+SPOOL_STALE_AFTER = int(os.getenv('SPOOL_STALE_AFTER', str(6 * 3600)))
+SPOOL_SWEEP_INTERVAL = int(os.getenv('SPOOL_SWEEP_INTERVAL', '600'))
+
+active_spool_paths = set()
+
+class Spool:
+    # FIFO scratch pipe for one transfer. Up to `memory_limit` bytes stay in RAM; when the
+    # reader falls further behind, newer bytes spill to a uniquely named file in SPOOL_DIR
+    # (at most SPOOL_MAX_FILE_SIZE) and the writer waits beyond that. Once the reader has
+    # drained the file it is truncated and RAM is used again, so small payloads never
+    # touch the disk.
+    def __init__(self, user_id, memory_limit, disk_limit=SPOOL_MAX_FILE_SIZE):
+        self.user_id = user_id
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.path = None
+        self._memory = bytearray()  # always older than anything on disk
+        self._fd = None
+        self._disk_read = 0
+        self._disk_write = 0
+        self._writing = False
+        self._wanted = 0
+        self._closed = False
+        self._error = None
+        self._file_io = set()  # pread/pwrite calls still running in the executor
+        self._changed = asyncio.Condition()
+
+    def _disk_pending(self):
+        return self._disk_write - self._disk_read
+
+    def buffered(self):
+        return len(self._memory) + self._disk_pending()
+
+    def _to_memory(self):
+        return not self._disk_pending() and len(self._memory) < self.memory_limit
+
+    async def _run_file_io(self, fn, *args):
+        # Cancelling the awaiting task cannot stop the executor thread, so the call is
+        # shielded and tracked; discard() waits for it before closing the descriptor,
+        # whose number could otherwise be reused by another transfer's file meanwhile.
+        future = asyncio.ensure_future(io_executor.run(self.user_id, fn, self._fd, *args))
+        self._file_io.add(future)
+        future.add_done_callback(self._file_io.discard)
+        return await asyncio.shield(future)
+
+    async def write(self, data):
+        async with self._changed:
+            # A reader waiting for more than is buffered always gets it, even past the disk
+            # limit, or a chunk larger than the spool would never complete.
+            await self._changed.wait_for(
+                lambda: self._to_memory()
+                or self._disk_write + len(data) <= self.disk_limit
+                or self.buffered() < self._wanted
+            )
+            if self._to_memory():
+                self._memory += data
+                self._changed.notify_all()
+                return
+            offset = self._disk_write
+            self._writing = True
+        try:
+            if self._fd is None:
+                os.makedirs(SPOOL_DIR, exist_ok=True)
+                self._fd, self.path = tempfile.mkstemp(prefix=f'{os.getpid()}-', suffix='.spool', dir=SPOOL_DIR)
+                active_spool_paths.add(self.path)
+            await self._run_file_io(os.pwrite, data, offset)
+        finally:
+            async with self._changed:
+                self._writing = False
+                self._changed.notify_all()
+        async with self._changed:
+            self._disk_write = offset + len(data)
+            governor.spooled(len(data))
+            self._changed.notify_all()
+
+    async def read(self, n):
+        # Returns up to n bytes and whether the stream ended right after them. Waits for
+        # one byte more than requested so a full chunk is never mistaken for the last one.
+        async with self._changed:
+            self._wanted = n + 1
+            self._changed.notify_all()
+            await self._changed.wait_for(lambda: self.buffered() > n or self._closed)
+            self._wanted = 0
+            if self._error:
+                raise self._error
+            chunk = bytes(self._memory[:n])
+            del self._memory[:n]
+            disk_offset = self._disk_read
+            disk_take = min(n - len(chunk), self._disk_pending())
+        if disk_take:
+            chunk += await self._run_file_io(os.pread, disk_take, disk_offset)
+        async with self._changed:
+            self._disk_read += disk_take
+            if disk_take and not self._disk_pending() and not self._writing:
+                # Writers wait on the lock we hold, so nothing lands in the file meanwhile
+                await self._run_file_io(os.ftruncate, 0)
+                governor.spooled(-self._disk_write)
+                self._disk_read = self._disk_write = 0
+            self._changed.notify_all()
+            return chunk, self._closed and not self.buffered()
+
+    async def close(self, error=None):
+        async with self._changed:
+            self._closed = True
+            self._error = error
+            self._changed.notify_all()
+
+    async def discard(self):
+        self._memory = bytearray()
+        if self._file_io:
+            await asyncio.gather(*self._file_io, return_exceptions=True)
+        if self._fd is not None:
+            governor.spooled(-self._disk_write)
+            self._disk_read = self._disk_write = 0
+            os.close(self._fd)
+            self._fd = None
+            active_spool_paths.discard(self.path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    async def chunks(self, n):
+        while True:
+            chunk, eof = await self.read(n)
+            if chunk:
+                yield chunk
+            if eof:
+                return
+
+def spool_reservation(size, memory_limit):
+    # Worst-case disk a transfer of `size` bytes (None if unknown) may spool
+    if size is not None and size <= memory_limit:
+        return 0
+    return min(size, SPOOL_MAX_FILE_SIZE) if size else SPOOL_MAX_FILE_SIZE
+
+async def stop_spool(producer, spool):
+    # The producer may be waiting on the network or on a pwrite; a pwrite keeps running in
+    # its thread after the cancel, and discard() waits for it before closing the file
+    producer.cancel()
+    with contextlib.suppress(asyncio.CancelledError, Exception):
+        await producer
+    await spool.discard()
+
+async def fill_spool(chunks, spool):
+    try:
+        async for data in chunks:
+            await spool.write(data)
+    except Exception as e:
+        await spool.close(e)
+    else:
+        await spool.close()
+
+async def iter_url(url):
+    async with get_http_session().get(url) as resp:
+        resp.raise_for_status()
+        async for data in resp.content.iter_chunked(TELEGRAM_READ_SIZE):
+            yield data
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def sweep_spool_dir():
+    # Removes spool files no live transfer owns: files of our own pid that are not
+    # active (leaked, or left by a previous run with the same pid), files of dead
+    # processes and anything older than SPOOL_STALE_AFTER.
+    if not os.path.isdir(SPOOL_DIR):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(SPOOL_DIR):
+        path = os.path.join(SPOOL_DIR, name)
+        if not name.endswith('.spool') or path in active_spool_paths:
+            continue
+        owner = name.split('-', 1)[0]
+        try:
+            orphan = (
+                not owner.isdigit()
+                or int(owner) == os.getpid()
+                or not pid_alive(int(owner))
+                or now - os.path.getmtime(path) > SPOOL_STALE_AFTER
+            )
+            if orphan:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info(f"Removed {removed} orphaned spool files from {SPOOL_DIR}")
+    return removed
+
+async def sweep_spool_periodically():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SPOOL_SWEEP_INTERVAL)
+        try:
+            await loop.run_in_executor(None, sweep_spool_dir)
+        except OSError as e:
+            logger.error(f"Spool sweep failed: {e}")
+
+UPLOAD_MAX_RETRIES = int(os.getenv('UPLOAD_MAX_RETRIES', '8'))
+UPLOAD_BACKOFF_BASE = float(os.getenv('UPLOAD_BACKOFF_BASE', '1.0'))
+UPLOAD_BACKOFF_MAX = float(os.getenv('UPLOAD_BACKOFF_MAX', '60'))
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Files up to this size go up in one multipart request instead of a resumable session
+MULTIPART_UPLOAD_THRESHOLD = int(os.getenv('MULTIPART_UPLOAD_THRESHOLD', str(5 * 1024 * 1024)))
+UPLOAD_FIELDS = 'id, name, md5Checksum'
+
+upload_metrics = {'uploads': 0, 'chunks': 0, 'bytes': 0, 'seconds': 0.0, 'retries': 0}
+# Time spent talking to Drive per finished upload, by strategy, to tune the threshold
+upload_latency = {
+    'multipart': {'uploads': 0, 'bytes': 0, 'seconds': 0.0},
+    'resumable': {'uploads': 0, 'bytes': 0, 'seconds': 0.0},
+}
+
+def record_upload_latency(strategy, size, seconds):
+    entry = upload_latency[strategy]
+    entry['uploads'] += 1
+    entry['bytes'] += size
+    entry['seconds'] += seconds
+    logger.info(f"{strategy.capitalize()} upload of {size} bytes took {seconds * 1000:.0f} ms on Drive")
+
+def is_retryable(error):
+    if isinstance(error, DriveError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, TokenUnavailable))
+
+def backoff_delay(attempt):
+    return min(UPLOAD_BACKOFF_MAX, UPLOAD_BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+class ResumableUpload:
+    # Sends one resumable session chunk by chunk. After a transient failure it backs off
+    # exponentially, asks Drive how many bytes it actually persisted and resends from
+    # there, so a flaky link never restarts the file from zero.
+    def __init__(self, client, upload_url, file_name):
+        self.client = client
+        self.upload_url = upload_url
+        self.file_name = file_name
+        self.offset = 0         # bytes acknowledged by Drive
+        self.chunk_times = []   # (bytes, seconds) for every chunk PUT
+        self.retries = 0
+
+    async def send(self, data, final):
+        # `data` continues at self.offset. Returns the created file after the final
+        # chunk, None otherwise; returns only once every byte of `data` is acknowledged.
+        total = self.offset + len(data) if final else None
+        attempt = 0
+        resync = False
+        while True:
+            try:
+                if resync:
+                    result, received = await self.client.upload_status(self.upload_url, total)
+                else:
+                    started = time.monotonic()
+                    result, received = await self.client.upload_chunk(self.upload_url, data, self.offset, total)
+                    self._record_chunk(len(data), time.monotonic() - started)
+            except Exception as e:
+                attempt += 1
+                if not is_retryable(e) or attempt > UPLOAD_MAX_RETRIES:
+                    raise
+                self.retries += 1
+                upload_metrics['retries'] += 1
+                delay = backoff_delay(attempt)
+                logger.warning(
+                    f"Upload of {self.file_name} failed at byte {self.offset} ({e}), retry {attempt} in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+                resync = True
+                continue
+            resync = False
+            if result is not None:
+                self.offset = total
+                return result
+            # Drive may persist less than we sent; keep the unacknowledged tail
+            if received > self.offset:
+                attempt = 0
+            data = data[received - self.offset:]
+            self.offset = received
+            if not data:
+                if not final:
+                    return None
+                # Everything arrived but the session was not finalized yet
+                resync = True
+
+    def drive_seconds(self):
+        return sum(t for _, t in self.chunk_times)
+
+    def _record_chunk(self, size, seconds):
+        self.chunk_times.append((size, seconds))
+        upload_metrics['chunks'] += 1
+        upload_metrics['bytes'] += size
+        upload_metrics['seconds'] += seconds
+        logger.debug(f"Upload chunk of {self.file_name}: {size} bytes in {seconds:.2f}s")
+
+    def summary(self):
+        size = sum(n for n, _ in self.chunk_times)
+        seconds = sum(t for _, t in self.chunk_times)
+        rate = size / seconds / 1024 / 1024 if seconds else 0.0
+        return f"{len(self.chunk_times)} chunks, {size} bytes, {rate:.2f} MiB/s, {self.retries} retries"
+
+async def upload_multipart(client, file_name, mime_type, data, parents=None):
+    # A failed multipart request leaves nothing behind on Drive, so retrying means
+    # resending the whole (small) body.
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        try:
+            result = await client.upload_multipart(file_name, mime_type, data, fields=UPLOAD_FIELDS, parents=parents)
+        except Exception as e:
+            attempt += 1
+            if not is_retryable(e) or attempt > UPLOAD_MAX_RETRIES:
+                raise
+            upload_metrics['retries'] += 1
+            delay = backoff_delay(attempt)
+            logger.warning(f"Multipart upload of {file_name} failed ({e}), retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        record_upload_latency('multipart', len(data), time.monotonic() - started)
+        return result
+
+class LocalFileSource:
+    # A file the local Bot API server already stored on this machine; chunks are read
+    # straight from disk instead of being copied over HTTP.
+    def __init__(self, user_id, path):
+        self.user_id = user_id
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.pos = 0
+
+    async def read(self, n):
+        chunk = await io_executor.run(self.user_id, os.pread, self.fd, n, self.pos)
+        self.pos += len(chunk)
+        return chunk, self.pos >= self.size
+
+    def close(self):
+        os.close(self.fd)
+
+def is_local_file_path(file_path):
+    return TELEGRAM_LOCAL_MODE and os.path.isabs(file_path)
+
+def check_md5(result, digest, file_name):
+    md5 = digest.hexdigest()
+    if result.get('md5Checksum') and result['md5Checksum'] != md5:
+        logger.warning(f"MD5 mismatch for {file_name}: sent {md5}, Drive has {result['md5Checksum']}")
+    result.setdefault('md5Checksum', md5)
+    return result
+
+async def stream_upload_to_drive(client, source, file_name, mime_type, size=None, progress=None, parents=None):
+    # Telegram download and Drive upload run concurrently through a spool, so the
+    # transfer takes about max(download, upload) and only a slow Drive side spills to disk.
+    # Drive only accepts a resumable session's chunks in order, so the overlap comes
+    # from reading the next chunk while the current one is in flight.
+    if is_local_file_path(source):
+        reader = LocalFileSource(client.user_id, source)
+        size = reader.size
+        producer = None
+    else:
+        reader = Spool(client.user_id, UPLOAD_BUFFER_SIZE)
+        producer = asyncio.create_task(fill_spool(iter_url(source), reader))
+    # The MD5 is computed on the way through and checked against Drive's; the dedup
+    # index relies on it
+    digest = hashlib.md5()
+    try:
+        if size is not None and size <= MULTIPART_UPLOAD_THRESHOLD:
+            data = bytearray()
+            eof = False
+            while not eof:
+                chunk, eof = await reader.read(UPLOAD_CHUNK_SIZE)
+                data += chunk
+            digest.update(data)
+            await governor.throttle(len(data))
+            result = await upload_multipart(client, file_name, mime_type, bytes(data), parents)
+            if progress is not None:
+                progress(len(data))
+            upload_metrics['uploads'] += 1
+            return check_md5(result, digest, file_name)
+        started = time.monotonic()
+        upload = ResumableUpload(
+            client, await client.create_resumable(file_name, mime_type, size, fields=UPLOAD_FIELDS, parents=parents),
+            file_name,
+        )
+        session_seconds = time.monotonic() - started
+        while True:
+            chunk, eof = await reader.read(UPLOAD_CHUNK_SIZE)
+            digest.update(chunk)
+            await governor.throttle(len(chunk))
+            result = await upload.send(chunk, eof)
+            if progress is not None:
+                progress(upload.offset)
+            if eof:
+                upload_metrics['uploads'] += 1
+                record_upload_latency('resumable', upload.offset, session_seconds + upload.drive_seconds())
+                logger.info(f"Uploaded {file_name}: {upload.summary()}")
+                return check_md5(result, digest, file_name)
+    finally:
+        if producer is not None:
+            await stop_spool(producer, reader)
+        else:
+            reader.close()
+
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+DOWNLOAD_BUFFER_SIZE = max(int(os.getenv('DOWNLOAD_BUFFER_SIZE', str(4 * 1024 * 1024))), 2 * DOWNLOAD_CHUNK_SIZE)
+
+async def send_document_stream(bot, chat_id, chunks, filename):
+    # PTB's InputFile reads the whole file into memory, so build the sendDocument
+    # multipart body ourselves and let aiohttp pull the parts from the async iterator.
+    with aiohttp.MultipartWriter('form-data') as form:
+        part = form.append(str(chat_id))
+        part.set_content_disposition('form-data', name='chat_id')
+        part = form.append(chunks, {'Content-Type': 'application/octet-stream'})
+        part.set_content_disposition('form-data', name='document', filename=filename)
+    async with get_http_session().post(f"{bot.base_url}/sendDocument", data=form) as resp:
+        result = await resp.json(content_type=None)
+    if not result.get('ok'):
+        raise RuntimeError(f"sendDocument failed: {result.get('description')}")
+    return result['result']
+
+TRANSFER_MAX_ACTIVE = int(os.getenv('TRANSFER_MAX_ACTIVE', '16'))
+TRANSFER_MAX_PER_USER = int(os.getenv('TRANSFER_MAX_PER_USER', '2'))
+TRANSFER_FAST_SLOTS = int(os.getenv('TRANSFER_FAST_SLOTS', '4'))  # extra slots only fast-lane jobs may use
+TRANSFER_FAST_LANE_SIZE = int(os.getenv('TRANSFER_FAST_LANE_SIZE', str(5 * MB)))
+TRANSFER_QUANTUM = int(os.getenv('TRANSFER_QUANTUM', str(16 * MB)))
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '3'))
+PROGRESS_EDITS_PER_TICK = int(os.getenv('PROGRESS_EDITS_PER_TICK', '20'))  # stays well under Telegram's flood limits
+
+def format_size(size):
+    return f"{size / MB:.1f} MB"
+
+def format_eta(seconds):
+    if seconds < 60:
+        return f"{max(1, int(seconds))} detik"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} menit"
+    return f"{seconds / 3600:.1f} jam"
+
+MEMORY_BUDGET = int(os.getenv('MEMORY_BUDGET', str(256 * MB)))        # transfer buffers held in RAM
+DISK_BUDGET = int(os.getenv('DISK_BUDGET', str(1024 * MB)))           # transfer data spooled to disk
+BANDWIDTH_BUDGET = int(os.getenv('BANDWIDTH_BUDGET', '0'))            # bytes/s over all transfers, 0 = unlimited
+TRANSFER_QUEUE_LIMIT = int(os.getenv('TRANSFER_QUEUE_LIMIT', '500'))
+ADMISSION_MAX_WAIT = int(os.getenv('ADMISSION_MAX_WAIT', '1800'))     # seconds a new job may expect to wait
+
+class ResourceGovernor:
+    # Accounts for the RAM and disk every running transfer may use and the bandwidth all
+    # of them move. The scheduler only starts a job whose reservation fits, new jobs are
+    # refused with a retry-later reply when the backlog would not clear in time, and
+    # transfers are paced by a shared token bucket when a bandwidth budget is set.
+    def __init__(self, memory_budget, disk_budget, bandwidth_budget):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.bandwidth_budget = bandwidth_budget
+        self.memory_reserved = 0
+        self.disk_reserved = 0
+        self.disk_used = 0
+        self.shed = 0
+        self._allowance = bandwidth_budget
+        self._last_refill = time.monotonic()
+        self._recent = deque()  # (monotonic time, bytes) over the last few seconds
+
+    def fits(self, job):
+        return (
+            self.memory_reserved + job.memory <= self.memory_budget
+            and self.disk_reserved + job.disk <= self.disk_budget
+        )
+
+    def reserve(self, job):
+        self.memory_reserved += job.memory
+        self.disk_reserved += job.disk
+
+    def release(self, job):
+        self.memory_reserved -= job.memory
+        self.disk_reserved -= job.disk
+
+    def refusal(self, job, queued, eta):
+        # Returns why a new job is refused, or None to admit it
+        if job.memory > self.memory_budget or job.disk > self.disk_budget:
+            return "file ini melebihi kapasitas transfer bot"
+        if queued >= TRANSFER_QUEUE_LIMIT:
+            return "antrean transfer penuh"
+        if eta > ADMISSION_MAX_WAIT:
+            return f"antrean transfer baru akan kosong dalam {format_eta(eta)}"
+        return None
+
+    def spooled(self, delta):
+        self.disk_used += delta
+
+    async def throttle(self, n):
+        now = time.monotonic()
+        self._recent.append((now, n))
+        while self._recent and self._recent[0][0] < now - 5:
+            self._recent.popleft()
+        if not self.bandwidth_budget:
+            return
+        self._allowance = min(
+            self.bandwidth_budget, self._allowance + (now - self._last_refill) * self.bandwidth_budget
+        )
+        self._last_refill = now
+        self._allowance -= n
+        if self._allowance < 0:
+            await asyncio.sleep(-self._allowance / self.bandwidth_budget)
+
+    def throughput(self):
+        cutoff = time.monotonic() - 5
+        return sum(n for t, n in self._recent if t >= cutoff) / 5
+
+    def stats(self):
+        return {
+            'memory': self.memory_reserved,
+            'memory_budget': self.memory_budget,
+            'disk': self.disk_used,
+            'disk_reserved': self.disk_reserved,
+            'disk_budget': self.disk_budget,
+            'bandwidth': self.throughput(),
+            'bandwidth_budget': self.bandwidth_budget,
+            'shed': self.shed,
+        }
+
+governor = ResourceGovernor(MEMORY_BUDGET, DISK_BUDGET, BANDWIDTH_BUDGET)
+
+class TransferJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id, kind, name, size, run, failure_text, interactive=False, memory=0, disk=0):
+        self.id = next(TransferJob._ids)
+        self.user_id = str(user_id)
+        self.kind = kind            # 'upload' or 'download'
+        self.name = name
+        self.size = size or 0       # 0 when unknown
+        self.run = run              # async fn(job) -> final status text
+        self.failure_text = failure_text
+        self.lane = 'fast' if interactive or 0 < self.size <= TRANSFER_FAST_LANE_SIZE else 'bulk'
+        self.cost = self.size or TRANSFER_QUANTUM
+        self.memory = memory        # worst-case RAM and disk the transfer holds, reserved while it runs
+        self.disk = disk
+        self.done = 0               # bytes transferred so far
+        self.state = 'queued'
+        self.started_at = None
+        self.message = None         # status message edited as the job progresses
+        self.shown_text = None
+        self.shown_at = 0.0         # monotonic time of the last edit
+        self.message_ready = asyncio.Event()
+
+    def set_progress(self, done):
+        self.done = done
+
+class TransferScheduler:
+    # Runs uploads and downloads as jobs under a global and a per-user concurrency cap.
+    # Waiting jobs sit in two lanes, the fast lane (small files, interactive requests) is
+    # always served first and has a few reserved slots. Within a lane users take turns by
+    # deficit round robin weighted by job size, so a burst of large files from one user
+    # cannot starve everybody else.
+    LANES = ('fast', 'bulk')
+
+    def __init__(self, max_active, max_per_user, fast_slots, quantum):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.fast_slots = fast_slots
+        self.quantum = quantum
+        self._queues = {lane: OrderedDict() for lane in self.LANES}  # lane -> user_id -> deque of jobs
+        self._deficits = {lane: {} for lane in self.LANES}          # lane -> user_id -> bytes
+        self._active = set()
+        self._active_per_user = {}
+        self._tasks = set()         # running job tasks, referenced until they finish
+        self._ticker = None
+        self._edits_paused_until = 0.0  # set when Telegram asks us to slow down
+        self.rate = 2 * MB  # moving average of per-job throughput in bytes/s, drives the ETA
+        self.completed = 0
+        self.failed = 0
+
+    async def submit(self, message, job):
+        queued = sum(1 for _ in self._queued_jobs())
+        remaining = sum(j.cost for j in self._queued_jobs()) + sum(max(j.size - j.done, 0) for j in self._active)
+        reason = governor.refusal(job, queued, (remaining + job.cost) / (self.rate * self._capacity(job.lane)))
+        if reason:
+            governor.shed += 1
+            await message.reply_text(f"Server sedang sibuk ({reason}). Silakan coba lagi nanti.")
+            return False
+        # Jobs keep the user's state until they finish, however long they wait in the queue
+        storage.pin(job.user_id)
+        self._queues[job.lane].setdefault(job.user_id, deque()).append(job)
+        self._dispatch()
+        try:
+            job.shown_text = self.describe(job)
+            job.message = await message.reply_text(job.shown_text)
+        finally:
+            job.message_ready.set()
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._tick())
+        return True
+
+    def _capacity(self, lane):
+        return self.max_active + (self.fast_slots if lane == 'fast' else 0)
+
+    def _dispatch(self):
+        for lane in self.LANES:
+            while len(self._active) < self._capacity(lane):
+                job = self._pick(lane)
+                if job is None:
+                    break
+                self._start(job)
+
+    def _pick(self, lane):
+        queues = self._queues[lane]
+        deficits = self._deficits[lane]
+        def eligible(user_id):
+            return self._active_per_user.get(user_id, 0) < self.max_per_user and governor.fits(queues[user_id][0])
+
+        if not any(eligible(u) for u in queues):
+            return None
+        while True:
+            user_id = next(iter(queues))
+            queues.move_to_end(user_id)
+            if not eligible(user_id):
+                continue
+            deficits[user_id] = deficits.get(user_id, 0) + self.quantum
+            job = queues[user_id][0]
+            if job.cost > deficits[user_id]:
+                continue
+            deficits[user_id] -= job.cost
+            queues[user_id].popleft()
+            if not queues[user_id]:
+                del queues[user_id]
+                del deficits[user_id]
+            return job
+
+    def _start(self, job):
+        job.state = 'running'
+        job.started_at = time.monotonic()
+        self._active.add(job)
+        governor.reserve(job)
+        self._active_per_user[job.user_id] = self._active_per_user.get(job.user_id, 0) + 1
+        task = asyncio.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job):
+        text = job.failure_text
+        try:
+            text = await job.run(job)
+            self.completed += 1
+        except Exception as e:
+            logger.error(f"Transfer job {job.id} ({job.kind} '{job.name}') failed: {e}")
+            self.failed += 1
+        finally:
+            elapsed = time.monotonic() - job.started_at
+            if job.done and elapsed > 0:
+                self.rate = 0.8 * self.rate + 0.2 * (job.done / elapsed)
+            job.state = 'done'
+            self._active.discard(job)
+            governor.release(job)
+            self._active_per_user[job.user_id] -= 1
+            if not self._active_per_user[job.user_id]:
+                del self._active_per_user[job.user_id]
+            storage.unpin(job.user_id)
+            self._dispatch()
+        await job.message_ready.wait()
+        # The final status must arrive, so wait out a flood pause instead of skipping it
+        await asyncio.sleep(max(0.0, self._edits_paused_until - time.monotonic()))
+        await self._show(job, text)
+
+    def _queued_jobs(self):
+        for lane in self.LANES:
+            for user_queue in self._queues[lane].values():
+                yield from user_queue
+
+    def describe(self, job):
+        label = 'Upload' if job.kind == 'upload' else 'Pengiriman'
+        if job.state == 'queued':
+            ahead = [j for j in self._queued_jobs() if j.id < job.id and (j.lane == job.lane or j.lane == 'fast')]
+            remaining = sum(j.cost for j in ahead) + job.cost
+            remaining += sum(max(j.size - j.done, 0) for j in self._active)
+            eta = remaining / (self.rate * self._capacity(job.lane))
+            return (
+                f"{label} '{job.name}' masuk antrean, posisi {len(ahead) + 1}, "
+                f"perkiraan selesai dalam {format_eta(eta)}."
+            )
+        if job.size:
+            percent = min(100, job.done * 100 // job.size)
+            return f"{label} '{job.name}': {percent}% ({format_size(job.done)}/{format_size(job.size)})"
+        return f"{label} '{job.name}': {format_size(job.done)}"
+
+    async def _show(self, job, text):
+        if job.message is None or text == job.shown_text:
+            return
+        job.shown_text = text
+        job.shown_at = time.monotonic()
+        try:
+            await job.message.edit_text(text)
+        except RetryAfter as e:
+            self._edits_paused_until = time.monotonic() + e.retry_after
+            job.shown_text = None  # shown again once edits resume
+            logger.warning(f"Telegram flood control, pausing status edits for {e.retry_after}s")
+        except TelegramError as e:
+            logger.debug(f"Could not update status of job {job.id}: {e}")
+
+    async def _tick(self):
+        # Refresh queue positions and progress until nothing is left. At most
+        # PROGRESS_EDITS_PER_TICK messages are edited per tick, those waiting longest
+        # first, so hundreds of queued jobs do not run into Telegram's flood limits.
+        while self._active or any(self._queues[lane] for lane in self.LANES):
+            await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+            if time.monotonic() < self._edits_paused_until:
+                continue
+            due = []
+            for job in list(self._active) + list(self._queued_jobs()):
+                if job.message_ready.is_set() and job.state != 'done':
+                    text = self.describe(job)
+                    if text != job.shown_text:
+                        due.append((job.shown_at, job.id, job, text))
+            due.sort(key=lambda entry: entry[:2])
+            for _, _, job, text in due[:PROGRESS_EDITS_PER_TICK]:
+                if time.monotonic() < self._edits_paused_until:
+                    break
+                await self._show(job, text)
+
+    def stats(self):
+        return {
+            'active': len(self._active),
+            'fast': sum(len(q) for q in self._queues['fast'].values()),
+            'bulk': sum(len(q) for q in self._queues['bulk'].values()),
+            'completed': self.completed,
+            'failed': self.failed,
+            'rate': self.rate,
+        }
+
+scheduler = TransferScheduler(TRANSFER_MAX_ACTIVE, TRANSFER_MAX_PER_USER, TRANSFER_FAST_SLOTS, TRANSFER_QUANTUM)
+
+async def counted_chunks(chunks, job):
+    async for chunk in chunks:
+        await governor.throttle(len(chunk))
+        job.done += len(chunk)
+        yield chunk